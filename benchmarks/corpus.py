@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+#
+# Synthetic documents for the benchmarks, in html (as exported from the
+# editor) or cnxmlplus, with a given number of sections, nesting depth,
+# density of maths and numbers, table size and number of images.
+#
+# Write a document to stdout, e.g.:
+#     python benchmarks/corpus.py --format cnxmlplus --sections 200 > book.cnxmlplus
+#
+import argparse
+import random
+import sys
+
+FORMATS = ['html', 'cnxmlplus']
+
+WORDS = ('the of and a to in is was that for it as with be by on not he this are or his from at which but have '
+         'an they you were her she there one all we their has been if more when will would who so no energy '
+         'force mass velocity acceleration cell molecule reaction solution graph function equation').split()
+
+FORMULAS = [
+    '<msup><mi>x</mi><mn>2</mn></msup><mo>+</mo><mn>%(n)s</mn>',
+    '<mfrac><mi>a</mi><mi>b</mi></mfrac><mo>=</mo><mn>%(n)s</mn>',
+    '<mi>sin</mi><mi>&#952;</mi><mo>&#215;</mo><mn>%(n)s</mn>',
+    '<msqrt><mi>v</mi><mo>+</mo><mn>%(n)s</mn></msqrt>',
+]
+
+TEX_FORMULAS = [r'x^2 + %(n)s', r'\frac{a}{b} = %(n)s', r'\sin\theta \times %(n)s', r'\sqrt{v + %(n)s}']
+
+UNITS = ['m', 'kg', 's', 'm<sup>-2</sup>', '&#176;C', 'J']
+
+
+class Corpus(object):
+    '''Generate the parts of a synthetic document.
+
+    math and numbers are the probabilities that a sentence contains a
+    formula or a number; formulas repeat, as they do across a book, so
+    that the maths caches see realistic hit rates.
+    '''
+    def __init__(self, format='cnxmlplus', sections=20, depth=2, paragraphs=4, math=0.3, numbers=0.3,
+                 tables=1, tableRows=4, tableColumns=3, images=1, seed=0):
+        if format not in FORMATS:
+            raise ValueError('unknown format %r' % format)
+        self.format = format
+        self.sections = sections
+        self.depth = depth
+        self.paragraphs = paragraphs
+        self.math = math
+        self.numbers = numbers
+        self.tables = tables
+        self.table_rows = tableRows
+        self.table_columns = tableColumns
+        self.images = images
+        self.random = random.Random(seed)
+        self.image_count = 0
+
+    def words(self, count):
+        return ' '.join([self.random.choice(WORDS) for i in range(count)])
+
+    def number(self):
+        return self.random.choice(['%i' % self.random.randint(1, 10**7),
+                                   '%.3f' % self.random.uniform(-1000, 1000),
+                                   '%.2e' % self.random.uniform(1e-6, 1e6)])
+
+    def formula(self):
+        values = {'n': self.random.randint(1, 20)}
+        if self.format == 'html':
+            return r'\(%s\)' % (self.random.choice(TEX_FORMULAS) % values)
+        return '<math xmlns="http://www.w3.org/1998/Math/MathML"><mrow>%s</mrow></math>' % (
+            self.random.choice(FORMULAS) % values)
+
+    def quantity(self):
+        number = self.number()
+        if self.format == 'html':
+            return number
+        kind = self.random.randint(0, 3)
+        if kind == 0:
+            return '<number>%s</number>' % number
+        if kind == 1:
+            return '<unit_number><number>%s</number><unit>%s</unit></unit_number>' % (
+                number, self.random.choice(UNITS))
+        if kind == 2:
+            return '<currency><number>%s</number></currency>' % number
+        return '<percentage>%i</percentage>' % self.random.randint(0, 100)
+
+    def sentence(self):
+        parts = [self.words(self.random.randint(4, 12))]
+        if self.random.random() < self.math:
+            parts.append(self.formula())
+        if self.random.random() < self.numbers:
+            parts.append(self.quantity())
+        parts.append(self.words(self.random.randint(2, 6)) + '.')
+        return ' '.join(parts)
+
+    def paragraph(self):
+        text = ' '.join([self.sentence() for i in range(self.random.randint(2, 5))])
+        if self.format == 'html':
+            return '<p>%s <strong>%s</strong></p>' % (text, self.words(2))
+        return '<para>%s <emphasis effect="bold">%s</emphasis></para>' % (text, self.words(2))
+
+    def image(self):
+        self.image_count += 1
+        if self.format == 'html':
+            return '<img src="images/img%i.png" alt="" width="%ipx;" />' % (
+                self.image_count, self.random.randint(100, 600))
+        return '<figure id="fig%i"><type>figure</type><image><src>images/img%i.png</src></image>' \
+               '<caption>%s</caption></figure>' % (self.image_count, self.image_count, self.words(5))
+
+    def table(self):
+        def cell():
+            if self.random.random() < self.numbers:
+                return self.quantity()
+            return self.words(self.random.randint(1, 3))
+        if self.format == 'html':
+            rows = ['<tr>%s</tr>' % ''.join(['<td>%s</td>' % cell() for j in range(self.table_columns)])
+                    for i in range(self.table_rows)]
+            return '<table><tbody>%s</tbody></table>' % ''.join(rows)
+        rows = ['<row>%s</row>' % ''.join(['<entry>%s</entry>' % cell() for j in range(self.table_columns)])
+                for i in range(self.table_rows)]
+        return '<table><tgroup cols="%i"><tbody>%s</tbody></tgroup></table>' % (self.table_columns, ''.join(rows))
+
+    def section(self, level):
+        title = self.words(3).capitalize()
+        parts = [self.paragraph() for i in range(self.paragraphs)]
+        parts.extend([self.table() for i in range(self.tables)])
+        parts.extend([self.image() for i in range(self.images)])
+        if level < self.depth:
+            parts.append(self.section(level + 1))
+        if self.format == 'html':
+            heading = 'h%i' % min(level, 3)
+            return '<%s>%s</%s>\n%s\n' % (heading, title, heading, '\n'.join(parts))
+        return '<section>\n<title>%s</title>\n%s\n</section>\n' % (title, '\n'.join(parts))
+
+    def document(self):
+        '''Return the document as a string.'''
+        sections = ''.join([self.section(1) for i in range(self.sections)])
+        if self.format == 'html':
+            return '<html><head></head><body>\n%s</body></html>\n' % sections
+        return '<document>\n<content>\n%s</content>\n</document>\n' % sections
+
+
+def generate(format='cnxmlplus', **options):
+    '''Return a synthetic document, see Corpus for the options.'''
+    return Corpus(format, **options).document()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write a synthetic document to stdout.')
+    parser.add_argument('--format', choices=FORMATS, default='cnxmlplus')
+    parser.add_argument('--sections', type=int, default=20, help='number of top-level sections')
+    parser.add_argument('--depth', type=int, default=2, help='nesting depth of sections')
+    parser.add_argument('--paragraphs', type=int, default=4, help='paragraphs per section')
+    parser.add_argument('--math', type=float, default=0.3, help='probability of a formula in a sentence')
+    parser.add_argument('--numbers', type=float, default=0.3, help='probability of a number in a sentence')
+    parser.add_argument('--tables', type=int, default=1, help='tables per section')
+    parser.add_argument('--table-rows', type=int, default=4)
+    parser.add_argument('--table-columns', type=int, default=3)
+    parser.add_argument('--images', type=int, default=1, help='images per section')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    sys.stdout.write(generate(args.format, sections=args.sections, depth=args.depth, paragraphs=args.paragraphs,
+                              math=args.math, numbers=args.numbers, tables=args.tables,
+                              tableRows=args.table_rows, tableColumns=args.table_columns,
+                              images=args.images, seed=args.seed))
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+#
+# Benchmark of delegate, which converts a tree with an explicit stack,
+# against recursive conversion with the same handlers, on synthetic
+# documents that are very deep (nested <div>/<span>) or very wide.
+#
+# Run from the top of the repository:
+#     python benchmarks/deep_nesting.py
+#
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+import html2latex
+from lxml import etree
+
+
+def delegate_recursive(element):
+    '''Convert element recursively, one Python call per nesting level, as
+    delegate used to.'''
+    if isinstance(element, etree._Comment):
+        return ''
+    handler = html2latex.start_handler(element)
+    fragments = []
+    for child in handler.children():
+        html2latex.conversion_state.context = handler.context
+        fragments.append(delegate_recursive(child))
+    handler.content['text'] += ''.join(fragments)
+    handler.finish()
+    return handler.render()
+
+
+def deep_document(depth):
+    '''Alternately nested <div> and <span> elements, as pasted by tinymce.'''
+    opening = ''.join(['<div class="level">' if i % 2 == 0 else '<span>' for i in range(depth)])
+    closing = ''.join(['</div>' if i % 2 == 0 else '</span>' for i in reversed(range(depth))])
+    return '<html><body>' + opening + 'deep &amp; text' + closing + '</body></html>'
+
+
+def wide_document(width):
+    '''A paragraph with many small inline elements.'''
+    return '<html><body><p>' + ''.join(['<b>%i</b> <i>x</i> ' % i for i in range(width)]) + '</p></body></html>'
+
+
+DOCUMENTS = [
+    ('deep 100', deep_document(100)),
+    ('deep 500', deep_document(500)),
+    ('deep 2000', deep_document(2000)),
+    ('wide 5000', wide_document(5000)),
+]
+
+
+def convert(function, text, repeat=3):
+    '''Return the output of function on the body of text and the best time
+    in seconds, or None and the error if it fails.'''
+    best = None
+    for i in range(repeat):
+        # handlers change the tree, so parse it again every time
+        root = etree.HTML(text, etree.HTMLParser(huge_tree=True))
+        element = root.find('.//body')[0]
+        start = time.time()
+        try:
+            output = function(element)
+        except RuntimeError, e:
+            return None, str(e)
+        finally:
+            html2latex.conversion_state.context = None
+        seconds = time.time() - start
+        best = seconds if best is None else min(best, seconds)
+    return output, best
+
+
+if __name__ == '__main__':
+    print '%-10s %8s %14s %14s' % ('document', 'elements', 'stack (ms)', 'recursive (ms)')
+    for name, text in DOCUMENTS:
+        elements = sum([1 for e in etree.HTML(text, etree.HTMLParser(huge_tree=True)).iter()])
+        output, seconds = convert(html2latex.delegate, text)
+        expected, recursiveSeconds = convert(delegate_recursive, text)
+        if expected is None:
+            recursive = 'fails'
+        else:
+            assert output == expected, name
+            recursive = '%14.1f' % (recursiveSeconds * 1000)
+        print '%-10s %8i %14.1f %14s' % (name, elements, seconds * 1000, recursive)
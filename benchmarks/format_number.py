@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+#
+# Micro-benchmark of format_number against the implementation it replaced.
+#
+# Run from the top of the repository:
+#     python benchmarks/format_number.py
+#
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+import html2latex
+
+
+def format_number_loop(numString, decimalSeparator=',', thousandsSeparator=r'\ '):
+    '''The original format_number, which inserts separators one at a time.'''
+    if numString[0] in '+-':
+        sign = {'+': '+', '-': '&#8722;'}[numString[0]]
+        numString = numString[1:]
+    else:
+        sign = ''
+    decimalPos = numString.find('.')
+    if decimalPos == -1:
+        intPart = numString
+        fracPart = None
+    else:
+        intPart = numString[:decimalPos]
+        fracPart = numString[decimalPos+1:]
+    # Add thousands separator to integer part
+    if len(intPart) > 4:
+        pos = len(intPart)-3
+        while pos > 0:
+            intPart = intPart[:pos] + thousandsSeparator + intPart[pos:]
+            pos -= 3
+    # Add thousandths separator to fractional part
+    if (fracPart is not None) and (len(fracPart) > 4):
+        pos = 3
+        while pos < len(fracPart):
+            fracPart = fracPart[:pos] + thousandsSeparator + fracPart[pos:]
+            pos += 3 + len(thousandsSeparator)
+    numString = sign + intPart
+    if fracPart is not None:
+        numString += decimalSeparator + fracPart
+    return numString
+
+
+NUMBERS = [
+    ('short', ['10', '2', '100', '0.5', '-3', '1500']),
+    ('medium', ['12345', '-1234567', '3.14159', '299792458', '0.000123456']),
+    ('long', ['1' * 60 + '.' + '2' * 60, '-' + '9' * 200]),
+]
+
+
+def check():
+    for name, numbers in NUMBERS:
+        for number in numbers:
+            for separators in [(',', r'\ '), ('.', ',')]:
+                expected = format_number_loop(number, *separators)
+                assert html2latex.format_number(number, *separators) == expected, number
+                assert html2latex.separate_digits(number, *separators) == expected, number
+
+
+def bench(function, numbers, repeat=5, number=2000):
+    def run():
+        for value in numbers:
+            function(value)
+    return min(timeit.repeat(run, repeat=repeat, number=number)) / (number * len(numbers)) * 1e6
+
+
+if __name__ == '__main__':
+    check()
+    print '%-8s %12s %12s %12s %12s' % ('numbers', 'loop (us)', 'join (us)', 'cached (us)', 'bulk (us)')
+    for name, numbers in NUMBERS:
+        loop = bench(format_number_loop, numbers)
+        join = bench(lambda n: html2latex.separate_digits(n, ',', r'\ '), numbers)
+        cached = bench(html2latex.format_number, numbers)
+        bulk = min(timeit.repeat(lambda: html2latex.format_numbers(numbers), repeat=5, number=2000)) / (2000 * len(numbers)) * 1e6
+        print '%-8s %12.2f %12.2f %12.2f %12.2f' % (name, loop, join, cached, bulk)
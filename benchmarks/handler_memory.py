@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+#
+# Memory and allocations of element handlers: html_element (slots, lazy
+# attribute lookup) against the per-node state it used to keep (an
+# instance dict and a content dict with a copy of every attribute).
+#
+# Run from the top of the repository:
+#     python benchmarks/handler_memory.py
+#
+import gc
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+import html2latex
+from lxml import etree
+
+NODES = 10000
+
+
+class eager_element(object):
+    '''The state html_element used to build for every element.'''
+    def __init__(self, element):
+        self.element = element
+        self.converter = html2latex.active_converter()
+        self.context = html2latex.element_context(element)
+        self.content = {}
+        self.content['text'] = element.text if element.text is not None else ''
+        self.content['tail'] = element.tail if element.tail is not None else ''
+        self.content['tag'] = html2latex.escape_latex(element.tag)
+        self.content['class'] = element.attrib.get('class', '')
+        self.template = self.converter.tag_template(element.tag)
+        for a in element.attrib:
+            self.content[a] = element.attrib[a]
+        self.content['text'] = html2latex.escape_latex(html2latex.clean(self.content['text']))
+        self.content['tail'] = html2latex.escape_latex(self.content['tail'])
+
+
+def leaves():
+    '''NODES inline elements with a few attributes, like pasted html.'''
+    spans = ''.join(['<span class="c%i" id="s%i" style="color: red">%i</span> ' % (i % 7, i, i) for i in range(NODES)])
+    return list(etree.HTML('<p>' + spans + '</p>').find('.//p'))
+
+
+def handler_size(handler):
+    size = sys.getsizeof(handler) + sys.getsizeof(handler.content)
+    if hasattr(handler, '__dict__'):
+        size += sys.getsizeof(handler.__dict__)
+    return size
+
+
+def measure(make):
+    elements = leaves()
+    # as in delegate, the context of each element is made from its parent's
+    html2latex.conversion_state.context = html2latex.element_context(elements[0].getparent())
+    gc.collect()
+    objects = len(gc.get_objects())
+    start = time.time()
+    handlers = [make(element) for element in elements]
+    seconds = time.time() - start
+    gc.collect()
+    tracked = len(gc.get_objects()) - objects - 1 # the list of handlers
+    size = sum([handler_size(handler) for handler in handlers])
+    return size, tracked, seconds
+
+
+if __name__ == '__main__':
+    print 'per %i <span> handlers:' % NODES
+    print '%-14s %12s %16s %10s' % ('', 'bytes', 'tracked objects', 'ms')
+    for name, make in [('eager dict', eager_element), ('html_element', html2latex.html_element)]:
+        size, tracked, seconds = measure(make)
+        print '%-14s %12i %16i %10.1f' % (name, size, tracked, seconds * 1000)
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+#
+# Benchmark suite: converts synthetic documents (see corpus.py) with the
+# html and cnxmlplus templates, timing each phase of the conversion, and
+# compares the results of two runs.
+#
+# Run from the top of the repository:
+#     python benchmarks/suite.py run -o before.json
+#     ... change something ...
+#     python benchmarks/suite.py run -o after.json
+#     python benchmarks/suite.py compare before.json after.json
+#
+# compare exits with status 1 if a phase got slower by more than the
+# threshold (10% by default).
+#
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+import html2latex
+import corpus
+
+PHASES = ['parse', 'transform', 'math', 'render', 'write']
+
+# name, template set, corpus options
+CASES = [
+    ('html-small', 'html', {'sections': 10}),
+    ('html-large', 'html', {'sections': 200}),
+    ('html-tables', 'html', {'sections': 20, 'tables': 3, 'tableRows': 20, 'tableColumns': 5}),
+    ('cnxmlplus-small', 'cnxmlplus', {'sections': 10}),
+    ('cnxmlplus-large', 'cnxmlplus', {'sections': 200}),
+    ('cnxmlplus-deep', 'cnxmlplus', {'sections': 100, 'depth': 5}), # the deepest sections have a template
+    ('cnxmlplus-math', 'cnxmlplus', {'sections': 50, 'math': 1.0, 'numbers': 0.1}),
+    ('cnxmlplus-numbers', 'cnxmlplus', {'sections': 50, 'math': 0.0, 'numbers': 1.0}),
+    ('cnxmlplus-tables', 'cnxmlplus', {'sections': 50, 'tables': 3, 'tableRows': 30, 'tableColumns': 5}),
+    ('cnxmlplus-images', 'cnxmlplus', {'sections': 50, 'images': 10}),
+]
+
+
+def convert(converter, text, out):
+    '''Convert text to out, returning the seconds spent in each phase.'''
+    seconds = {}
+    start = time.time()
+    root = converter.parse(text)
+    seconds['parse'] = time.time() - start
+
+    start = time.time()
+    body = converter.body(root)
+    seconds['transform'] = time.time() - start
+
+    start = time.time()
+    math = converter.convert_math(body)
+    seconds['math'] = time.time() - start
+
+    start = time.time()
+    fragments = []
+    converter.convert_elements(body, fragments.append, math)
+    seconds['render'] = time.time() - start
+
+    start = time.time()
+    writer = html2latex.LatexWriter(out, converter.get_template('doc.tex'))
+    for fragment in fragments:
+        writer.write(fragment)
+    writer.close()
+    seconds['write'] = time.time() - start
+    return seconds
+
+
+def run_case(templateSet, options, repeat):
+    '''Return the best time of each phase over repeat conversions, and the
+    size of the document and of its LaTeX.'''
+    text = corpus.generate(templateSet, **options)
+    converter = html2latex.Converter(templateSet)
+    best = dict([(phase, None) for phase in PHASES])
+    for i in range(repeat):
+        # measure the maths conversion, not the cache
+        converter.math_cache = html2latex.MathCache()
+        out = tempfile.TemporaryFile()
+        try:
+            seconds = convert(converter, text, out)
+            size = out.tell()
+        finally:
+            out.close()
+        for phase in PHASES:
+            if (best[phase] is None) or (seconds[phase] < best[phase]):
+                best[phase] = seconds[phase]
+    best['total'] = sum([best[phase] for phase in PHASES])
+    elements = sum([1 for element in converter.parse(text).iter()])
+    return {'elements': elements, 'input_bytes': len(text), 'output_bytes': size, 'seconds': best}
+
+
+def run(args):
+    results = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'repeat': args.repeat,
+        'cases': {},
+    }
+    print '%-20s %8s %s %9s' % ('case', 'elements', ' '.join(['%9s' % phase for phase in PHASES]), 'total')
+    for name, templateSet, options in CASES:
+        if args.cases and (name not in args.cases):
+            continue
+        result = run_case(templateSet, options, args.repeat)
+        results['cases'][name] = result
+        seconds = result['seconds']
+        print '%-20s %8i %s %9.1f' % (name, result['elements'],
+                                      ' '.join(['%9.1f' % (seconds[phase] * 1000) for phase in PHASES]),
+                                      seconds['total'] * 1000)
+    print '(times in ms, best of %i)' % args.repeat
+    if args.output is not None:
+        open(args.output, 'w').write(json.dumps(results, indent=2, sort_keys=True))
+    return 0
+
+
+def compare(args):
+    '''Compare two runs; a phase regressed if it is slower by more than
+    threshold (a fraction) and by more than minimum seconds, which keeps
+    the noise of very short phases out.'''
+    before = json.load(open(args.before))['cases']
+    after = json.load(open(args.after))['cases']
+    regressions = []
+    print '%-20s %-10s %12s %12s %8s' % ('case', 'phase', 'before (ms)', 'after (ms)', 'change')
+    for name in sorted(set(before) & set(after)):
+        for phase in PHASES + ['total']:
+            old = before[name]['seconds'][phase]
+            new = after[name]['seconds'][phase]
+            change = (new - old) / old if old > 0 else 0.0
+            flag = ''
+            if (change > args.threshold) and (new - old > args.minimum):
+                flag = ' REGRESSION'
+                regressions.append((name, phase))
+            print '%-20s %-10s %12.1f %12.1f %+7.1f%%%s' % (name, phase, old * 1000, new * 1000, change * 100, flag)
+    for name in sorted(set(before) ^ set(after)):
+        print '%-20s only in %s' % (name, args.before if name in before else args.after)
+    if len(regressions) > 0:
+        print '%i regression(s) over %.0f%%' % (len(regressions), args.threshold * 100)
+        return 1
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark html2latex on synthetic documents.')
+    commands = parser.add_subparsers()
+    runParser = commands.add_parser('run', help='time the conversion of each case')
+    runParser.add_argument('-o', '--output', metavar='PATH', help='write the results to PATH as JSON')
+    runParser.add_argument('-r', '--repeat', type=int, default=3, help='conversions per case, the best is kept')
+    runParser.add_argument('cases', nargs='*', help='the cases to run, all by default: %s' % (
+        ', '.join([name for name, templateSet, options in CASES])))
+    runParser.set_defaults(command=run)
+    compareParser = commands.add_parser('compare', help='compare the results of two runs')
+    compareParser.add_argument('before')
+    compareParser.add_argument('after')
+    compareParser.add_argument('-t', '--threshold', type=float, default=0.1,
+                               help='slowdown reported as a regression, as a fraction (default 0.1)')
+    compareParser.add_argument('-m', '--minimum', type=float, default=0.005,
+                               help='ignore slowdowns of less than this many seconds (default 0.005)')
+    compareParser.set_defaults(command=compare)
+    args = parser.parse_args(argv)
+    return args.command(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -6,10 +6,24 @@ import sys
 import os
 import re, htmlentitydefs
 import urllib
+import urllib2
+import urlparse
+import threading
+import time
+import copy
+import hashlib
+import inspect
+import sqlite3
+import argparse
+import json
+import glob
+import functools
+import multiprocessing
+import multiprocessing.pool
+from collections import OrderedDict
 
 from lxml import etree
 import jinja2
-from jinja2.exceptions import TemplateNotFound
 
 
 # Functions for outputting message to stderr
@@ -26,210 +40,929 @@ def information_message(message, newLine=True):
     if newLine:
         sys.stderr.write('\n')
 
+class ConversionError(Exception):
+    '''Raised by error_message when the conversion of a file cannot go on.'''
+    pass
+
 def error_message(message, newLine=True, terminate=True):
-    global commandlineArguments
+    '''Output an error message to stderr, or, if terminate is set, stop
+    converting the current file by raising ConversionError with it; the
+    message is then reported by whoever catches the error (convert_files
+    lists the files that failed at the end of the run).'''
+    if terminate:
+        raise ConversionError(message)
     sys.stderr.write('ERROR: ' + message)
     if newLine:
         sys.stderr.write('\n')
-    if terminate:
-        sys.exit()
 
 
 # Some boilerplate to use jinja more elegantly with LaTeX
 # http://flask.pocoo.org/snippets/55/
 
-LATEX_SUBS = (
-    (re.compile(r'\\'), r'\\textbackslash'),
-    (re.compile(r'([{}_#%&$])'), r'\\\1'),
-    (re.compile(r'~'), r'\~{}'),
-    (re.compile(r'\^'), r'\^{}'),
-    (re.compile(r'"'), r"''"),
-    (re.compile(r'\.\.\.+'), r'\\ldots'),
-)
+class Translator(object):
+    '''Apply a set of string replacements in a single scan of the text.
+
+    pattern is a regular expression matching every piece of text that gets
+    replaced.  The matched text is looked up in replacements; text that is
+    not in there is passed to fallback, which returns its replacement.
+    '''
+    def __init__(self, pattern, replacements, fallback=None):
+        self.regex = re.compile(pattern)
+        self.replacements = replacements
+        self.fallback = fallback
+
+    def __call__(self, text):
+        return self.regex.sub(self.replace, text)
+
+    def replace(self, match):
+        text = match.group(0)
+        replacement = self.replacements.get(text)
+        if replacement is None:
+            replacement = self.fallback(text)
+        return replacement
+
+LATEX_SUBS = Translator(r'\.\.\.+|[\\{}_#%&$~^"]', {
+    '\\': r'\textbackslash',
+    '{': r'\{', '}': r'\}', '_': r'\_', '#': r'\#', '%': r'\%', '&': r'\&', '$': r'\$',
+    '~': r'\~{}',
+    '^': r'\^{}',
+    '"': r"''",
+}, fallback=lambda text: r'\ldots')
 
 def escape_tex(value):
-    newval = value
-    for pattern, replacement in LATEX_SUBS:
-        newval = pattern.sub(replacement, newval)
-    return newval
-
+    return LATEX_SUBS(value)
+
+
+# Compiled XSLT stylesheets, shared by every element that needs them.
+
+class XSLTCache(object):
+    '''Compile XSLT stylesheets on first use and keep them for the process.
+
+    mmltex.xsl includes five more stylesheets (one of them the 70 KB entity
+    table), so compiling it per <math> element dominates the conversion of
+    maths-heavy documents.  The cache is safe to share between threads; hits
+    and misses are counted so that long-running workers can check it.
+    '''
+    def __init__(self, directory):
+        self.directory = directory
+        self.stylesheets = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, name):
+        '''Return the compiled stylesheet called name from the cache directory.'''
+        with self.lock:
+            stylesheet = self.stylesheets.get(name)
+            if stylesheet is not None:
+                self.hits += 1
+                return stylesheet
+            self.misses += 1
+            stylesheet = etree.XSLT(etree.parse(os.path.join(self.directory, name)))
+            self.stylesheets[name] = stylesheet
+            return stylesheet
+
+    def warm(self, names=('mmltex.xsl',)):
+        '''Compile the given stylesheets ahead of time, e.g. when a worker starts.'''
+        for name in names:
+            if name not in self.stylesheets:
+                self.get(name)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'compiled': len(self.stylesheets)}
+
+xslt_cache = XSLTCache(os.path.dirname(os.path.realpath(__file__)) + '/templates/xslt')
+
+
+# Memoization of MathML to LaTeX conversions
+
+class LRUCache(object):
+    '''A bounded, thread-safe mapping that drops the least recently used entries.
+
+    Entries are kept in a circular doubly linked list of [previous, next,
+    key, value] lists, most recently used last, so that lookups and updates
+    take constant time.
+    '''
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self.entries = {}
+        self.root = []
+        self.root[:] = [self.root, self.root, None, None]
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            link = self.entries.get(key)
+            if link is None:
+                return default
+            self.move_to_end(link)
+            return link[3]
+
+    def put(self, key, value):
+        with self.lock:
+            link = self.entries.get(key)
+            if link is not None:
+                link[3] = value
+                self.move_to_end(link)
+                return
+            last = self.root[0]
+            link = [last, self.root, key, value]
+            last[1] = self.root[0] = self.entries[key] = link
+            if len(self.entries) > self.maxsize:
+                oldest = self.root[1]
+                self.root[1] = oldest[1]
+                oldest[1][0] = self.root
+                del self.entries[oldest[2]]
+
+    def move_to_end(self, link):
+        '''Make the entry of link the most recently used; the lock must be held.'''
+        previous, following = link[0], link[1]
+        previous[1] = following
+        following[0] = previous
+        last = self.root[0]
+        last[1] = self.root[0] = link
+        link[0] = last
+        link[1] = self.root
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class MathCache(object):
+    '''Remember the LaTeX for MathML formulas, keyed by their canonical XML.
+
+    The same formulas turn up over and over across a book, so conversions
+    are kept in memory (bounded LRU) and, if a path is given, in an sqlite
+    database that can be shared between runs and worker processes.  The
+    database is emptied when it was filled by other stylesheets or another
+    version of the code that cleans up their output (see math_version).
+    '''
+    def __init__(self, maxsize=10000, path=None):
+        self.memory = LRUCache(maxsize)
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        self.lock = threading.Lock()
+        self.store = None
+        self.path = None
+        if path is not None:
+            self.open(path)
+
+    def open(self, path, version=None):
+        '''Keep conversions in the sqlite database at path as well.  Its
+        conversions are dropped unless they were made by version, by default
+        that of the current stylesheets and code.'''
+        if version is None:
+            version = math_version()
+        with self.lock:
+            self.path = path
+            self.store = sqlite3.connect(path, timeout=60, check_same_thread=False)
+            self.store.execute('CREATE TABLE IF NOT EXISTS math (key TEXT PRIMARY KEY, latex TEXT)')
+            self.store.execute('CREATE TABLE IF NOT EXISTS version (version TEXT)')
+            row = self.store.execute('SELECT version FROM version').fetchone()
+            if (row is None) or (row[0] != version):
+                self.store.execute('DELETE FROM math')
+                self.store.execute('DELETE FROM version')
+                self.store.execute('INSERT INTO version VALUES (?)', (version,))
+            self.store.commit()
+
+    def key(self, element):
+        return hashlib.sha1(etree.tostring(element, method='c14n')).hexdigest()
+
+    def get(self, key):
+        '''Return the LaTeX stored under key, or None.'''
+        latex = self.memory.get(key)
+        if (latex is None) and (self.store is not None):
+            with self.lock:
+                row = self.store.execute('SELECT latex FROM math WHERE key = ?', (key,)).fetchone()
+            if row is not None:
+                latex = row[0]
+                self.memory.put(key, latex)
+        with self.lock:
+            if latex is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.bytes_saved += len(latex.encode('utf-8'))
+        return latex
+
+    def put(self, key, latex):
+        self.memory.put(key, latex)
+        if self.store is not None:
+            with self.lock:
+                self.store.execute('INSERT OR REPLACE INTO math VALUES (?, ?)', (key, latex))
+
+    def flush(self):
+        '''Commit new conversions to the database so that other processes see them.'''
+        if self.store is not None:
+            with self.lock:
+                self.store.commit()
+
+    def report(self):
+        lookups = self.hits + self.misses
+        if lookups > 0:
+            information_message('MathML cache: %i hits, %i misses (%.1f%% hit rate), %i bytes saved'%(
+                self.hits, self.misses, 100.0*self.hits/lookups, self.bytes_saved))
+
+math_cache = MathCache()
+
+
+class FragmentCache(object):
+    '''Keep the LaTeX of top-level elements on disk, keyed by fingerprint.
+
+    Used for incremental rebuilds: an element whose fingerprint (see
+    Converter.fingerprint) was seen before is not converted again.  Each
+    fragment is a file in the cache directory; nothing is cached until a
+    directory is opened.
+    '''
+    def __init__(self, directory=None):
+        self.directory = None
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        if directory is not None:
+            self.open(directory)
+
+    def open(self, directory):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+
+    def filename(self, key):
+        return os.path.join(self.directory, key[:2], key + '.tex')
+
+    def get(self, key):
+        '''Return the LaTeX stored under key, or None.'''
+        try:
+            latex = open(self.filename(key), 'rb').read().decode('utf-8')
+        except IOError:
+            latex = None
+        with self.lock:
+            if latex is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return latex
 
-# 
+    def put(self, key, latex):
+        filename = self.filename(key)
+        temporary = '%s.%i.%i.tmp'%(filename, os.getpid(), threading.current_thread().ident)
+        try:
+            if not os.path.isdir(os.path.dirname(filename)):
+                os.makedirs(os.path.dirname(filename))
+            f = open(temporary, 'wb')
+            try:
+                f.write(latex.encode('utf-8'))
+            finally:
+                f.close()
+            os.rename(temporary, filename)
+        except (IOError, OSError), e:
+            warning_message('Could not write to the fragment cache: %s'%e)
+
+    def report(self):
+        lookups = self.hits + self.misses
+        if lookups > 0:
+            information_message('Fragment cache: %i of %i elements reused'%(self.hits, lookups))
+
+fragment_cache = FragmentCache()
+
+
+# Images
+
+# The formats of images, by the bytes they start with
+IMAGE_SIGNATURES = [
+    ('\x89PNG\r\n\x1a\n', '.png'),
+    ('\xff\xd8\xff', '.jpg'),
+    ('GIF87a', '.gif'),
+    ('GIF89a', '.gif'),
+    ('%PDF', '.pdf'),
+    ('%!PS', '.eps'),
+]
+
+def image_extension(data, source=''):
+    '''Return the file extension for the image data, from its first bytes,
+    or else from the name of its source.'''
+    for signature, extension in IMAGE_SIGNATURES:
+        if data.startswith(signature):
+            return extension
+    extension = os.path.splitext(urlparse.urlparse(source).path)[1].lower()
+    return extension if extension in ['.png', '.jpg', '.jpeg', '.gif', '.pdf', '.eps'] else ''
+
+class AssetCache(object):
+    '''Local copies of the images of documents, named by their content.
+
+    The images of a document are fetched together, by a pool of threads,
+    from file paths, file:// URLs or http(s) URLs, and stored in the cache
+    directory under the SHA-1 of their content, so an image used by many
+    documents is stored once.  The file a URL was stored in is remembered
+    in the directory too, so it is not downloaded again.  Nothing is
+    fetched until a directory is opened.
+    '''
+    def __init__(self, directory=None, jobs=8, timeout=30):
+        self.directory = None
+        self.jobs = jobs
+        self.timeout = timeout
+        self.fetched = 0
+        self.reused = 0
+        self.failed = 0
+        self.lock = threading.Lock()
+        # the files this process has stored or is storing
+        self.stored = set()
+        if directory is not None:
+            self.open(directory)
+
+    def open(self, directory):
+        # the LaTeX refers to the images by absolute path, so that it can
+        # be compiled anywhere
+        directory = os.path.abspath(directory)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.directory = directory
+
+    def count(self, name):
+        with self.lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def location(self, source, baseDir=None):
+        '''Return the URL or absolute file name of source.'''
+        scheme = urlparse.urlparse(source).scheme
+        if scheme in ['http', 'https']:
+            return source
+        if scheme == 'file':
+            return urllib.url2pathname(urlparse.urlparse(source).path)
+        if len(scheme) > 1:
+            return None # e.g. data: URLs, which are left alone
+        return os.path.abspath(os.path.join(baseDir or os.curdir, source))
+
+    def index_file(self, url):
+        return os.path.join(self.directory, 'urls', hashlib.sha1(url).hexdigest())
+
+    def write(self, filename, data):
+        '''Write data to filename atomically, so that other processes never
+        see part of it.'''
+        if not os.path.isdir(os.path.dirname(filename)):
+            try:
+                os.makedirs(os.path.dirname(filename))
+            except OSError:
+                pass # made by another thread meanwhile
+        temporary = '%s.%i.%i.tmp'%(filename, os.getpid(), threading.current_thread().ident)
+        f = open(temporary, 'wb')
+        try:
+            f.write(data)
+        finally:
+            f.close()
+        os.rename(temporary, filename)
+
+    def store(self, data, source):
+        '''Store the image data and return its file name.'''
+        name = hashlib.sha1(data).hexdigest() + image_extension(data, source)
+        filename = os.path.join(self.directory, name[:2], name)
+        # two threads may fetch the same image from different sources
+        with self.lock:
+            new = (filename not in self.stored) and not os.path.exists(filename)
+            self.stored.add(filename)
+        if new:
+            self.write(filename, data)
+            self.count('fetched')
+        else:
+            self.count('reused')
+        return filename
 
-def etree_in_context(iNode, iContext):
-    parent = iNode.getparent()
-    while parent is not None:
-        if parent.tag == iContext:
-            return True
-        parent = parent.getparent()
-    return False
-
-
-def transform(dom):
-        # Currency
-        for currencyNode in dom.xpath('//currency'):
-            latexMode = etree_in_context(currencyNode, 'latex')
-            symbolNode = currencyNode.find('symbol')
-            if symbolNode is None:
-                symbol = 'R'
-                symbolLocation = 'front'
-            else:
-                symbol = symbolNode.text.strip()
-                symbolLocation = symbolNode.attrib.get('location', 'front')
-            numberNode = currencyNode.find('number')
-            if numberNode.text is None:
-                numberNode.text = ''
-            # Set default precision to 0 if number is an int, and to 2 if it is a float
+    def fetch(self, location):
+        '''Return the file name of the local copy of location, or None if
+        it cannot be read.'''
+        try:
+            if location.startswith(('http://', 'https://')):
+                index = self.index_file(location)
+                if os.path.exists(index):
+                    filename = open(index).read()
+                    if os.path.exists(filename):
+                        self.count('reused')
+                        return filename
+                data = urllib2.urlopen(location, timeout=self.timeout).read()
+                filename = self.store(data, location)
+                self.write(index, filename)
+                return filename
+            return self.store(open(location, 'rb').read(), location)
+        except (IOError, OSError, ValueError), e:
+            # urllib2 errors are IOErrors too
+            warning_message('Could not fetch image %s: %s'%(location, e))
+            self.count('failed')
+            return None
+
+    def resolve(self, sources, baseDir=None):
+        '''Return a dict from each of sources that could be fetched to the
+        file name of its local copy.  Relative paths are taken from baseDir,
+        or else the current directory.'''
+        locations = {}
+        for source in sources:
+            location = self.location(source, baseDir)
+            if location is not None:
+                locations.setdefault(location, []).append(source)
+        if len(locations) == 0:
+            return {}
+        jobs = min(self.jobs, len(locations))
+        if jobs == 1:
+            filenames = [self.fetch(location) for location in locations]
+        else:
+            pool = multiprocessing.pool.ThreadPool(jobs)
             try:
-                int(numberNode.text.strip())
-                defaultPrecision = 0
-            except ValueError:
-                defaultPrecision = 2
-            currencyPrecision = int(currencyNode.attrib.get('precision', defaultPrecision))
-            numberNode.text = ("%%.%if"%currencyPrecision)%float(numberNode.text.strip())
+                filenames = pool.map(self.fetch, list(locations))
+            finally:
+                pool.close()
+                pool.join()
+        paths = {}
+        for location, filename in zip(locations, filenames):
+            if filename is not None:
+                for source in locations[location]:
+                    paths[source] = filename
+        return paths
+
+    def report(self):
+        if self.fetched + self.reused + self.failed > 0:
+            information_message('Images: %i fetched, %i already in the cache, %i failed'%(
+                self.fetched, self.reused, self.failed))
+
+asset_cache = AssetCache()
+
+
+# Profiling
+
+class Profile(object):
+    '''Where the time of a conversion goes, by element tag and class.
+
+    For each (tag, class) it counts the elements converted, the wall time
+    spent on them with and without their descendants, the part of it spent
+    rendering templates and the bytes of LaTeX produced.  The time spent
+    in each of the rules of transform is kept as well.  A Profile can be
+    shared by threads; take and merge move the figures between processes.
+    '''
+    def __init__(self):
+        self.elements = {}
+        self.transform_timings = {}
+        self.lock = threading.Lock()
+        # the elements being converted by each thread, innermost last
+        self.frames = threading.local()
+
+    def start(self, element):
+        '''Start timing the conversion of element.'''
+        stack = getattr(self.frames, 'stack', None)
+        if stack is None:
+            stack = self.frames.stack = []
+        if not isinstance(element.tag, basestring):
+            tag = repr(element.tag)
+        elif element.tag.startswith('{'):
+            tag = etree.QName(element).localname # drop the namespace
+        else:
+            tag = element.tag
+        stack.append([tag, element.get('class') or '', time.time(), 0.0])
+
+    def stop(self, latex, renderSeconds, size=None):
+        '''Stop timing the innermost element, which produced latex (or size
+        bytes of LaTeX, if it was written in pieces).'''
+        stack = self.frames.stack
+        tag, elementClass, start, childSeconds = stack.pop()
+        seconds = time.time() - start
+        if len(stack) > 0:
+            stack[-1][3] += seconds
+        with self.lock:
+            figures = self.elements.get((tag, elementClass))
+            if figures is None:
+                figures = self.elements[(tag, elementClass)] = [0, 0.0, 0.0, 0.0, 0]
+            figures[0] += 1
+            figures[1] += seconds
+            figures[2] += seconds - childSeconds
+            figures[3] += renderSeconds
+            if size is None:
+                size = len(latex.encode('utf-8')) if isinstance(latex, unicode) else len(latex)
+            figures[4] += size
+
+    def depth(self):
+        '''Return the number of elements this thread is timing.'''
+        return len(getattr(self.frames, 'stack', ()))
+
+    def unwind(self, depth):
+        '''Stop timing, without recording them, the elements started after
+        depth elements were being timed: their conversion failed.'''
+        stack = getattr(self.frames, 'stack', None)
+        if stack is not None:
+            del stack[depth:]
+
+    def child_seconds(self):
+        '''Return the time spent so far on the elements converted within the
+        innermost element being timed, so that it can be left out of the
+        time spent rendering its template.'''
+        stack = getattr(self.frames, 'stack', None)
+        if not stack:
+            return 0.0
+        return stack[-1][3]
+
+    def add_transform_timings(self, timings):
+        with self.lock:
+            for name, seconds in timings.items():
+                self.transform_timings[name] = self.transform_timings.get(name, 0.0) + seconds
+
+    def take(self):
+        '''Return the figures as a dict that can be sent to another process,
+        and start again from zero.'''
+        with self.lock:
+            data = {'elements': [[tag, elementClass] + figures
+                                 for (tag, elementClass), figures in self.elements.items()],
+                    'transform': self.transform_timings}
+            self.elements = {}
+            self.transform_timings = {}
+        return data
+
+    def merge(self, data):
+        '''Add the figures of a dict returned by take.'''
+        with self.lock:
+            for row in data['elements']:
+                figures = self.elements.get((row[0], row[1]))
+                if figures is None:
+                    figures = self.elements[(row[0], row[1])] = [0, 0.0, 0.0, 0.0, 0]
+                for i in range(5):
+                    figures[i] += row[i + 2]
+        self.add_transform_timings(data['transform'])
+
+    def json(self):
+        '''Return the figures as a JSON document.'''
+        with self.lock:
+            elements = [{'tag': tag, 'class': elementClass, 'count': figures[0],
+                         'inclusive_seconds': figures[1], 'exclusive_seconds': figures[2],
+                         'render_seconds': figures[3], 'bytes': figures[4]}
+                        for (tag, elementClass), figures in self.elements.items()]
+            transform = dict(self.transform_timings)
+        elements.sort(key=lambda row: row['exclusive_seconds'], reverse=True)
+        return json.dumps({'elements': elements, 'transform': transform}, indent=2, sort_keys=True)
+
+    def report(self, out=sys.stderr, limit=None):
+        '''Write the figures as a table, the most expensive elements first.'''
+        with self.lock:
+            rows = sorted(self.elements.items(), key=lambda item: item[1][2], reverse=True)
+            transform = sorted(self.transform_timings.items(), key=lambda item: item[1], reverse=True)
+        if limit is not None:
+            rows = rows[:limit]
+        out.write('%-24s %-20s %8s %10s %10s %10s %10s\n'%(
+            'tag', 'class', 'count', 'incl (ms)', 'excl (ms)', 'render (ms)', 'bytes'))
+        for (tag, elementClass), figures in rows:
+            out.write('%-24s %-20s %8i %10.1f %10.1f %10.1f %10i\n'%(
+                tag[:24], elementClass[:20], figures[0], figures[1]*1000, figures[2]*1000, figures[3]*1000, figures[4]))
+        if len(transform) > 0:
+            out.write('\n%-24s %10s\n'%('transform rule', 'time (ms)'))
+            for name, seconds in transform:
+                out.write('%-24s %10.1f\n'%(name, seconds*1000))
+
+
+# MathML to LaTeX
+
+MATHML_TAG = '{http://www.w3.org/1998/Math/MathML}math'
+MATH_SEPARATOR = u'\ue000'
+TRIG_FUNCTIONS = ['sin', 'cos', 'tan', 'cot']
+MATH_FIXES = re.compile(u'\\\\&|\\\\stackrel\\{\\^\\}|(\u00d7)((?:sin|cos|tan|cot)*)| ((?:sin|cos|tan|cot)+)')
+
+def fix_math_match(match):
+    text = match.group(0)
+    if text == u'\\&':
+        return u'&'
+    if text == u'\\stackrel{^}':
+        # replace the stackrel{^} with hat
+        return u'\\hat'
+    if match.group(1) is not None:
+        # fix the \times symbol
+        output = u' \\times'
+        functions = match.group(2)
+    else:
+        output = u''
+        functions = match.group(3)
+    # fix the trig functions too. A function directly after a converted one
+    # is only converted if it comes later in TRIG_FUNCTIONS, which is what
+    # replacing them one after the other used to do.
+    previous = -1
+    for i in range(0, len(functions), 3):
+        index = TRIG_FUNCTIONS.index(functions[i:i+3])
+        if index <= previous:
+            return output + u' ' + functions[i:]
+        output += u'\\' + functions[i:i+3]
+        previous = index
+    return output + u' '
+
+def fix_math_latex(tex):
+    '''Clean up the LaTeX that mmltex.xsl produced for one formula.'''
+    text = escape_latex(tex.replace('$', ''))
+    # fix the autosizing bracket issue. Must have matching brackets in every math environment.
+    # If they don't match, remove the autosizing \left and \right
+    if text.count('\\left') != text.count('\\right'):
+        text = text.replace('\\left', '').replace('\\right', '')
+    return MATH_FIXES.sub(fix_math_match, text)
+
+def math_version(directory=xslt_cache.directory):
+    '''Return a hash of the MathML stylesheets in directory and of the code
+    that cleans up their output, which the LaTeX in a MathCache depends on.'''
+    version = hashlib.sha1()
+    for path in sorted(glob.glob(os.path.join(directory, '*.xsl'))):
+        version.update(os.path.basename(path) + '\0' + open(path, 'rb').read() + '\0')
+    for function in (fix_math_latex, fix_math_match, escape_latex, LATEX_ESCAPES.fallback):
+        version.update(inspect.getsource(function) + '\0')
+    for pattern in (MATH_FIXES.pattern, LATEX_ESCAPES.regex.pattern):
+        version.update(pattern.encode('utf-8') + '\0')
+    version.update(repr((TRIG_FUNCTIONS, sorted(LATEX_ESCAPES.replacements.items()))))
+    return version.hexdigest()
+
+def mathml_to_latex(element, xsltCache=xslt_cache, mathCache=math_cache):
+    '''Convert a single MathML element to LaTeX.'''
+    key = mathCache.key(element)
+    text = mathCache.get(key)
+    if text is None:
+        transform = xsltCache.get('mmltex.xsl')
+        text = fix_math_latex(unicode(transform(element)))
+        mathCache.put(key, text)
+    return text
 
-            replacementNode = etree.Element('dummy')
-            if symbolLocation == 'front':
-                if latexMode:
-                    replacementNode.text = r'\text{' + symbol + ' }'
-                else:
-                    replacementNode.text = symbol + u'\u00a0'
-                replacementNode.append(numberNode)
-            else:
-                replacementNode.append(numberNode)
-                if latexMode:
-                    replacementNode.tail = r'\text{ ' + symbol + '}'
-                else:
-                    replacementNode.tail = u'\u00a0' + symbol
-            etree_replace_with_node_list(currencyNode.getparent(), currencyNode, replacementNode)
-
-        # Percentage
-        for percentageNode in dom.xpath('//percentage'):
-            latexMode = etree_in_context(percentageNode, 'latex')
-            percentageNode.tag = 'number'
-            if percentageNode.tail is None:
-                percentageNode.tail = ''
-            if latexMode:
-                percentageNode.tail = r'\%' + percentageNode.tail
-            else:
-                percentageNode.tail = '%' + percentageNode.tail
+def convert_math_batch(root, xsltCache=xslt_cache, mathCache=math_cache):
+    '''Convert all MathML elements below root with a single XSLT run.
+
+    Formulas found in mathCache are taken from there.  Copies of the rest
+    are collected in one container, separated by a marker character, and
+    the output is split on the markers again.  Returns a dict mapping each
+    math element to its LaTeX.
+    '''
+    results = {}
+    pending = OrderedDict()
+    for element in root.iter(MATHML_TAG):
+        key = mathCache.key(element)
+        if key in pending:
+            pending[key].append(element)
+            continue
+        text = mathCache.get(key)
+        if text is None:
+            pending[key] = [element]
+        else:
+            results[element] = text
+    if len(pending) == 0:
+        return results
+
+    container = etree.Element('mathbatch')
+    for elements in pending.values():
+        mathCopy = copy.deepcopy(elements[0])
+        mathCopy.tail = MATH_SEPARATOR
+        container.append(mathCopy)
+    transform = xsltCache.get('mmltex.xsl')
+    texs = unicode(transform(container)).split(MATH_SEPARATOR)[:-1]
+    if len(texs) != len(pending):
+        # The marker showed up inside some formula; do them one by one.
+        warning_message('Could not split batched MathML output, converting formulas one at a time')
+        texs = [unicode(transform(elements[0])) for elements in pending.values()]
+    for (key, elements), tex in zip(pending.items(), texs):
+        text = fix_math_latex(tex)
+        mathCache.put(key, text)
+        for element in elements:
+            results[element] = text
+    mathCache.flush()
+    return results
 
-        # United numbers: ensure that units follow numbers
-        for node in dom.xpath('//unit_number'):
-            if (len(node) == 2) and (node[0].tag == 'unit') and (node[1].tag == 'number'):
-                unitNode = node[0]
-                numberNode = node[1]
-                del node[0]
-                del node[0]
-                node.append(numberNode)
-                node.append(unitNode)
 
-        # Numbers
-        for numberNode in dom.xpath('//number'):
-            # Avoid shortcode exercise numbers
-            if (numberNode.getparent().tag == 'entry') and (numberNode.getparent().getparent().tag == 'shortcodes'):
-                continue
-            latexMode = etree_in_context(numberNode, 'latex')
-            if (len(numberNode) == 0) and ('e' in numberNode.text):
-                # Number in exponential notation: convert to <coeff> and <exp>
-                numberText = numberNode.text
-                float(numberText) # Check that it is really a float
-                numberNode.text = None
-                numberNode.append(etree.Element('coeff'))
-                pos = numberText.find('e')
-                numberNode[-1].text = numberText[:pos]
-                numberNode.append(etree.Element('exp'))
-                numberNode[-1].text = str(int(numberText[pos+1:]))
-
-            if len(numberNode) == 0:
-                # No children, means it's just a plain number
-                coeffText = format_number(numberNode.text.strip())
-                try:
-                    if latexMode:
-                        dummyNode = etree.fromstring(r'<dummy>\text{' + coeffText + '}</dummy>')
-                    else:
-                        dummyNode = etree.fromstring('<dummy>' + coeffText + '</dummy>')
-                except etree.XMLSyntaxError, msg:
-                    print repr(coeffText)
-                    raise etree.XMLSyntaxError, msg
+# 
+
+def transform(dom, timings=None):
+    '''Rewrite the cnxmlplus currency, percentage, number and unit markup.
+
+    The rules are applied during a single walk over the tree, which keeps
+    track of whether it is inside a <latex> element.  The walk uses a
+    stack rather than recursion, so deeply nested documents do not hit the
+    recursion limit.  If timings is a dict, the seconds spent in each rule
+    are added to it, keyed by rule name.
+    '''
+    transform_elements(list(dom), timings)
+
+def transform_elements(elements, timings=None):
+    '''Apply the transform rules to elements and everything below them.'''
+    # Each entry is a node, whether it is inside <latex>, and the rule to
+    # apply once its children are done (None if the node is still to visit)
+    stack = [(element, False, None) for element in reversed(elements)]
+    while len(stack) > 0:
+        node, latexMode, rule = stack.pop()
+        if rule is not None:
+            apply_transform_rule(rule[0], rule[1], node, latexMode, timings)
+            continue
+        tag = node.tag
+        if tag == 'currency':
+            numberNode = apply_transform_rule('currency', transform_currency, node, latexMode, timings)
+            apply_transform_rule('number', transform_number, numberNode, latexMode, timings)
+        elif tag == 'percentage':
+            apply_transform_rule('percentage', transform_percentage, node, latexMode, timings)
+            apply_transform_rule('number', transform_number, node, latexMode, timings)
+        elif tag == 'number':
+            apply_transform_rule('number', transform_number, node, latexMode, timings)
+        elif tag == 'unit_number':
+            apply_transform_rule('unit_number order', order_unit_number, node, latexMode, timings)
+            stack.append((node, latexMode, ('unit_number', unwrap_unit_number)))
+            push_transform_children(stack, node, latexMode)
+        elif tag == 'unit':
+            stack.append((node, latexMode, ('unit', transform_unit)))
+            push_transform_children(stack, node, latexMode)
+        else:
+            push_transform_children(stack, node, latexMode or (tag == 'latex'))
+
+def push_transform_children(stack, node, latexMode):
+    # The rules replace elements with text, so push a copy of the list,
+    # reversed so that the first child is popped first
+    for child in reversed(list(node)):
+        stack.append((child, latexMode, None))
+
+def apply_transform_rule(name, rule, node, latexMode, timings):
+    if timings is None:
+        return rule(node, latexMode)
+    start = time.time()
+    result = rule(node, latexMode)
+    timings[name] = timings.get(name, 0.0) + time.time() - start
+    return result
+
+def transform_currency(currencyNode, latexMode):
+    '''Replace a <currency> with its symbol and <number>, which is returned.'''
+    symbolNode = currencyNode.find('symbol')
+    if symbolNode is None:
+        symbol = 'R'
+        symbolLocation = 'front'
+    else:
+        symbol = symbolNode.text.strip()
+        symbolLocation = symbolNode.attrib.get('location', 'front')
+    numberNode = currencyNode.find('number')
+    if numberNode.text is None:
+        numberNode.text = ''
+    # Set default precision to 0 if number is an int, and to 2 if it is a float
+    try:
+        int(numberNode.text.strip())
+        defaultPrecision = 0
+    except ValueError:
+        defaultPrecision = 2
+    currencyPrecision = int(currencyNode.attrib.get('precision', defaultPrecision))
+    numberNode.text = ("%%.%if"%currencyPrecision)%float(numberNode.text.strip())
+
+    replacementNode = etree.Element('dummy')
+    if symbolLocation == 'front':
+        if latexMode:
+            replacementNode.text = r'\text{' + symbol + ' }'
+        else:
+            replacementNode.text = symbol + u'\u00a0'
+        replacementNode.append(numberNode)
+    else:
+        replacementNode.append(numberNode)
+        if latexMode:
+            replacementNode.tail = r'\text{ ' + symbol + '}'
+        else:
+            replacementNode.tail = u'\u00a0' + symbol
+    etree_replace_with_node_list(currencyNode.getparent(), currencyNode, replacementNode)
+    return numberNode
+
+def transform_percentage(percentageNode, latexMode):
+    '''Turn a <percentage> into a <number> followed by a percent sign.'''
+    percentageNode.tag = 'number'
+    if percentageNode.tail is None:
+        percentageNode.tail = ''
+    if latexMode:
+        percentageNode.tail = r'\%' + percentageNode.tail
+    else:
+        percentageNode.tail = '%' + percentageNode.tail
+
+def order_unit_number(node, latexMode):
+    '''United numbers: ensure that units follow numbers'''
+    if (len(node) == 2) and (node[0].tag == 'unit') and (node[1].tag == 'number'):
+        unitNode = node[0]
+        numberNode = node[1]
+        del node[0]
+        del node[0]
+        node.append(numberNode)
+        node.append(unitNode)
+
+def transform_number(numberNode, latexMode):
+    '''Replace a <number> with the formatted number.'''
+    # Avoid shortcode exercise numbers
+    if (numberNode.getparent().tag == 'entry') and (numberNode.getparent().getparent().tag == 'shortcodes'):
+        return
+    if (len(numberNode) == 0) and ('e' in numberNode.text):
+        # Number in exponential notation: convert to <coeff> and <exp>
+        numberText = numberNode.text
+        float(numberText) # Check that it is really a float
+        numberNode.text = None
+        numberNode.append(etree.Element('coeff'))
+        pos = numberText.find('e')
+        numberNode[-1].text = numberText[:pos]
+        numberNode.append(etree.Element('exp'))
+        numberNode[-1].text = str(int(numberText[pos+1:]))
+
+    if len(numberNode) == 0:
+        # No children, means it's just a plain number
+        coeffText = format_number(numberNode.text.strip())
+        if latexMode:
+            dummyNode = number_node(r'\text{' + coeffText + '}')
+        else:
+            dummyNode = number_node(coeffText)
+    else:
+        # Scientific or exponential notation: parse out coefficient, base and exponent
+        coeffNode = numberNode.find('coeff')
+        expNode = numberNode.find('exp')
+        baseNode = numberNode.find('base')
+        if coeffNode is None:
+            # Exponential
+            if baseNode is None:
+                baseText = format_number('10')
             else:
-                # Scientific or exponential notation: parse out coefficient, base and exponent
-                coeffNode = numberNode.find('coeff')
-                expNode = numberNode.find('exp')
-                baseNode = numberNode.find('base')
-                if coeffNode is None:
-                    # Exponential
-                    if baseNode is None:
-                        baseText = format_number('10')
-                    else:
-                        baseText = format_number(baseNode.text.strip())
-                    assert expNode is not None, etree.tostring(numberNode)
-                    expText = format_number(expNode.text.strip())
-                    if latexMode:
-                        dummyNode = etree.fromstring(r'<dummy>\text{' + baseText + r'}^{\text{' + expText + r'}}</dummy>')
-                    else:
-                        dummyNode = etree.fromstring('<dummy>' + baseText + '<sup>' + expText + '</sup></dummy>')
-                else:
-                    # Scientific notation or plain number (<coeff> only)
-                    coeffText = format_number(coeffNode.text.strip())
-                    if expNode is None:
-                        assert baseNode is None
-                        try:
-                            if latexMode:
-                                dummyNode = etree.fromstring(r'<dummy>\text{' + coeffText + '}</dummy>')
-                            else:
-                                dummyNode = etree.fromstring('<dummy>' + coeffText + '</dummy>')
-                        except etree.XMLSyntaxError, msg:
-                            print repr(coeffText)
-                            raise etree.XMLSyntaxError, msg
-                    else:
-                        if baseNode is None:
-                            baseText = format_number('10')
-                        else:
-                            baseText = format_number(baseNode.text.strip())
-                        expText = format_number(expNode.text.strip())
-                        if latexMode:
-                            dummyNode = etree.fromstring(r'<dummy>\text{' + coeffText + r' } &#215; \text{ ' + baseText + r'}^{\text{' + expText + r'}}</dummy>')
-                        else:
-                            dummyNode = etree.fromstring('<dummy>' + coeffText + ' &#215; ' + baseText + '<sup>' + expText + '</sup></dummy>')
-            etree_replace_with_node_list(numberNode.getparent(), numberNode, dummyNode)
-
-        # Units
-        for unitNode in dom.xpath('//unit'):
-            latexMode = etree_in_context(unitNode, 'latex')
-            if unitNode.text is None:
-                unitNode.text = ''
-            unitNode.text = unitNode.text.lstrip()
+                baseText = format_number(baseNode.text.strip())
+            assert expNode is not None, etree.tostring(numberNode)
+            expText = format_number(expNode.text.strip())
             if latexMode:
-                unitNode.text = r'\text{' + unitNode.text
-            if len(unitNode) == 0:
-                unitNode.text = unitNode.text.rstrip()
-                if latexMode:
-                    unitNode.text += '}'
+                dummyNode = number_node(r'\text{' + baseText + r'}^{\text{' + expText + r'}}')
             else:
-                if unitNode[-1].tail is None:
-                    unitNode[-1].tail = ''
-                unitNode[-1].tail = unitNode[-1].tail.rstrip()
-                if latexMode:
-                    unitNode[-1].tail += '}'
-            if (unitNode.getparent().tag == 'unit_number') and (unitNode.text[0] != u'\xb0'):
-                # Leave space between number and unit, except for degrees
+                dummyNode = number_node(baseText, expText)
+        else:
+            # Scientific notation or plain number (<coeff> only)
+            coeffText = format_number(coeffNode.text.strip())
+            if expNode is None:
+                assert baseNode is None
                 if latexMode:
-                    unitNode.text = r'\ ' + unitNode.text
+                    dummyNode = number_node(r'\text{' + coeffText + '}')
                 else:
-                    unitNode.text = ' ' + unitNode.text
-            for sup in unitNode:
-                assert sup.tag == 'sup'
+                    dummyNode = number_node(coeffText)
+            else:
+                if baseNode is None:
+                    baseText = format_number('10')
+                else:
+                    baseText = format_number(baseNode.text.strip())
+                expText = format_number(expNode.text.strip())
                 if latexMode:
-                    sup.text = '$^{' + sup.text.strip() + '}$'
-                    etree_replace_with_node_list(unitNode, sup, sup)
+                    dummyNode = number_node(r'\text{' + coeffText + r' } &#215; \text{ ' + baseText + r'}^{\text{' + expText + r'}}')
                 else:
-                    sup.text = sup.text.strip().replace('-', u'\u2212')
-            etree_replace_with_node_list(unitNode.getparent(), unitNode, unitNode)
+                    dummyNode = number_node(coeffText + ' &#215; ' + baseText, expText)
+    etree_replace_with_node_list(numberNode.getparent(), numberNode, dummyNode)
+
+NUMBER_ENTITIES = {'&#215;': u'\u00d7', '&#8722;': u'\u2212'}
+NUMBER_ENTITY_RE = re.compile('|'.join(NUMBER_ENTITIES.keys()))
+
+def number_node(text, supText=None):
+    '''Build the <dummy> element that replaces a number.
+
+    The element holds text, followed by a <sup> holding supText if that is
+    given.  The character references that format_number and transform_number
+    use are resolved directly; text with any other markup in it is run
+    through the XML parser instead.
+    '''
+    resolve = lambda match: NUMBER_ENTITIES[match.group(0)]
+    resolvedText = NUMBER_ENTITY_RE.sub(resolve, text)
+    if supText is None:
+        resolvedSup = ''
+    else:
+        resolvedSup = NUMBER_ENTITY_RE.sub(resolve, supText)
+    if ('<' in resolvedText + resolvedSup) or ('&' in resolvedText + resolvedSup):
+        if supText is None:
+            xml = '<dummy>' + text + '</dummy>'
+        else:
+            xml = '<dummy>' + text + '<sup>' + supText + '</sup></dummy>'
+        try:
+            return etree.fromstring(xml)
+        except etree.XMLSyntaxError:
+            error_message('Could not parse number: ' + repr(xml), terminate=False)
+            raise
+    dummyNode = etree.Element('dummy')
+    dummyNode.text = resolvedText or None
+    if supText is not None:
+        etree.SubElement(dummyNode, 'sup').text = resolvedSup or None
+    return dummyNode
+
+def transform_unit(unitNode, latexMode):
+    '''Replace a <unit> with its text and <sup> elements.'''
+    if unitNode.text is None:
+        unitNode.text = ''
+    unitNode.text = unitNode.text.lstrip()
+    if latexMode:
+        unitNode.text = r'\text{' + unitNode.text
+    if len(unitNode) == 0:
+        unitNode.text = unitNode.text.rstrip()
+        if latexMode:
+            unitNode.text += '}'
+    else:
+        if unitNode[-1].tail is None:
+            unitNode[-1].tail = ''
+        unitNode[-1].tail = unitNode[-1].tail.rstrip()
+        if latexMode:
+            unitNode[-1].tail += '}'
+    if (unitNode.getparent().tag == 'unit_number') and (unitNode.text[0] != u'\xb0'):
+        # Leave space between number and unit, except for degrees
+        if latexMode:
+            unitNode.text = r'\ ' + unitNode.text
+        else:
+            unitNode.text = ' ' + unitNode.text
+    for sup in unitNode:
+        assert sup.tag == 'sup'
+        if latexMode:
+            sup.text = '$^{' + sup.text.strip() + '}$'
+            etree_replace_with_node_list(unitNode, sup, sup)
+        else:
+            sup.text = sup.text.strip().replace('-', u'\u2212')
+    etree_replace_with_node_list(unitNode.getparent(), unitNode, unitNode)
 
-        # United numbers
-        for node in dom.xpath('//unit_number'):
-            etree_replace_with_node_list(node.getparent(), node, node)
+def unwrap_unit_number(node, latexMode):
+    '''Replace a <unit_number> with its (already transformed) contents.'''
+    etree_replace_with_node_list(node.getparent(), node, node)
 
 def etree_replace_with_node_list(parent, child, dummyNode, keepTail=True):
     index = parent.index(child)
@@ -270,42 +1003,221 @@ def etree_replace_with_node_list(parent, child, dummyNode, keepTail=True):
         for i in range(len(dummyNode)-1, -1, -1):
             parent.insert(index, dummyNode[i])
 
+# Formatted numbers, keyed by (number, decimal separator, thousands
+# separator).  A document uses the same few numbers over and over, so a
+# plain dict, emptied when it gets full, is quicker than an LRUCache: a
+# lookup costs less than formatting even the shortest number.
+number_cache = {}
+NUMBER_CACHE_SIZE = 4096
+
 def format_number(numString, decimalSeparator=',', thousandsSeparator=r'\ '):
     """
     Replace standard decimal point with new decimal separator
     (default: comma); add thousands and thousandths separators
     (default: non-breaking space).
     """
+    key = (numString, decimalSeparator, thousandsSeparator)
+    result = number_cache.get(key)
+    if result is None:
+        result = separate_digits(numString, decimalSeparator, thousandsSeparator)
+        if len(number_cache) >= NUMBER_CACHE_SIZE:
+            number_cache.clear()
+        number_cache[key] = result
+    return result
+
+def format_numbers(numStrings, decimalSeparator=',', thousandsSeparator=r'\ '):
+    '''Format a list of numbers with format_number.'''
+    return [format_number(numString, decimalSeparator, thousandsSeparator) for numString in numStrings]
+
+def separate_digits(numString, decimalSeparator, thousandsSeparator):
+    '''Do the work of format_number, without the cache.'''
     if numString[0] in '+-':
         sign = {'+': '+', '-': '&#8722;'}[numString[0]]
         numString = numString[1:]
     else:
         sign = ''
-    decimalPos = numString.find('.')
-    if decimalPos == -1:
-        intPart = numString
-        fracPart = None
-    else:
-        intPart = numString[:decimalPos]
-        fracPart = numString[decimalPos+1:]
-    # Add thousands separator to integer part
+    intPart, decimalPoint, fracPart = numString.partition('.')
+    # Add thousands separator to integer part, in groups of three from the right
     if len(intPart) > 4:
-        pos = len(intPart)-3
-        while pos > 0:
-            intPart = intPart[:pos] + thousandsSeparator + intPart[pos:]
-            pos -= 3
-    # Add thousandths separator to fractional part
-    if (fracPart is not None) and (len(fracPart) > 4):
-        pos = 3
-        while pos < len(fracPart):
-            fracPart = fracPart[:pos] + thousandsSeparator + fracPart[pos:]
-            pos += 3 + len(thousandsSeparator)
-    numString = sign + intPart
-    if fracPart is not None:
-        numString += decimalSeparator + fracPart
-    return numString
-
+        head = len(intPart)%3 or 3
+        intPart = thousandsSeparator.join([intPart[:head]] + [intPart[i:i+3] for i in range(head, len(intPart), 3)])
+    # Add thousandths separator to fractional part, in groups of three from the left
+    if len(fracPart) > 4:
+        fracPart = thousandsSeparator.join([fracPart[i:i+3] for i in range(0, len(fracPart), 3)])
+    if decimalPoint == '':
+        return sign + intPart
+    return sign + intPart + decimalSeparator + fracPart
+
+
+
+
+# Element handlers, looked up by delegate()
+
+# tag -> handler class
+element_handlers = {}
+# (tag, class attribute) -> handler class
+class_handlers = {}
+# tag -> list of (class substring, handler class), and the compiled
+# alternation of those substrings
+class_patterns = {}
+class_pattern_res = {}
+
+def register(*tags, **kwargs):
+    '''Class decorator that makes delegate() use a handler for the given tags.
+
+    With css_class='name' the handler is only used for elements with exactly
+    that class attribute; with class_pattern='name-' for elements whose class
+    attribute contains the given string.  Exact classes are tried first, then
+    patterns, then handlers registered for the bare tag.
+    '''
+    css_class = kwargs.get('css_class')
+    class_pattern = kwargs.get('class_pattern')
+    def decorator(handler):
+        for tag in tags:
+            if css_class is not None:
+                class_handlers[(tag, css_class)] = handler
+            elif class_pattern is not None:
+                patterns = class_patterns.setdefault(tag, [])
+                patterns.append((class_pattern, handler))
+                class_pattern_res[tag] = re.compile('|'.join(['(%s)'%re.escape(p) for p, h in patterns]))
+            else:
+                element_handlers[tag] = handler
+        return handler
+    return decorator
+
+def find_handler(element):
+    '''Return the handler class for element.'''
+    tag = element.tag
+    elementClass = element.get('class')
+    handler = class_handlers.get((tag, elementClass))
+    if handler is not None:
+        return handler
+    if elementClass and (tag in class_pattern_res):
+        match = class_pattern_res[tag].search(elementClass)
+        if match is not None:
+            return class_patterns[tag][match.lastindex - 1][1]
+    return element_handlers.get(tag, html_element)
+
+
+# Where elements are in the document
+
+FLOAT_TAGS = frozenset(['exercise', 'worked_example', 'activity', 'exercises'])
+
+# The structure of html and CALS (cnxmlplus) tables.  The rows of a row
+# group are converted with the table's; thead and tfoot are not supported.
+ROW_TAGS = frozenset(['tr', 'row'])
+ROW_GROUP_TAGS = frozenset(['tbody', 'tgroup'])
+TABLE_PART_TAGS = ROW_TAGS | ROW_GROUP_TAGS | frozenset(['thead', 'tfoot'])
+
+class TableModel(object):
+    '''The structure of a table, found once for the table's context.
+
+    items lists what the table holds, in document order: ('row', row),
+    ('start', group) and ('end', group) around the rows of a row group,
+    and ('other', element) for anything else, such as a caption.  html
+    tells an html table from a cnxmlplus one, by its tr rows.  ncols is
+    the largest number of cells in a row (of td or of th cells, in an
+    html row), counting those of tables nested in the row's cells.
+    Nested tables have their own model.
+    '''
+    __slots__ = ('element', 'items', 'rows', 'ncols', 'html', 'tgroup')
 
+    def __init__(self, element):
+        self.element = element
+        self.items = []
+        self.rows = 0
+        self.html = element.find('.//tr') is not None
+        self.tgroup = element.find('.//tgroup') is not None
+        if self.html:
+            self.ncols = max([0] + [max(len(row.findall('.//td')), len(row.findall('.//th')))
+                                    for row in element.iterdescendants('tr')])
+        else:
+            self.ncols = max([0] + [len(row.findall('.//entry'))
+                                    for row in element.iterdescendants('row')])
+        pending = [('other', child) for child in reversed(element)]
+        while len(pending) > 0:
+            kind, child = pending.pop()
+            tag = child.tag
+            if kind == 'end':
+                self.items.append((kind, child))
+            elif tag in ROW_TAGS:
+                self.rows += 1
+                self.items.append(('row', child))
+            elif tag in ROW_GROUP_TAGS:
+                self.items.append(('start', child))
+                pending.append(('end', child))
+                pending.extend([('other', grandchild) for grandchild in reversed(child)])
+            elif not isinstance(child, etree._Comment):
+                self.items.append(('other', child))
+
+    def column_spec(self, alignment):
+        '''Return a longtable column spec of ncols paragraph columns that
+        share 85% of the text width, with alignment (e.g. \\centering).'''
+        ncols = max(self.ncols, 1)
+        column = r">{%s}p{%1.3f\textwidth}"%(alignment, 0.85/ncols)
+        return '|' + '|'.join([column]*ncols) + '|'
+
+    def image_width(self):
+        '''Return the width of an image in a cell, as a fraction of the
+        text width.'''
+        return 0.75/max(self.ncols, 1)
+
+
+class ElementContext(object):
+    '''What an element is nested in, counting the element itself.
+
+    The context of an element is made from that of its parent, so finding
+    out whether an element is inside a table takes constant time instead
+    of a walk over its ancestors.
+    '''
+    __slots__ = ('element', 'parent', 'inside_table', 'inside_float', 'section_depth', 'inside_latex',
+                 'table')
+
+    def __init__(self, element=None, parent=None, inside_table=False, inside_float=False,
+                 section_depth=0, inside_latex=False, table=None):
+        self.element = element
+        self.parent = parent
+        self.inside_table = inside_table
+        self.inside_float = inside_float
+        self.section_depth = section_depth
+        self.inside_latex = inside_latex
+        # the TableModel of the innermost table
+        self.table = table
+
+    def enter(self, element):
+        '''Return the context of element, a child of this context's element.'''
+        tag = element.tag
+        return ElementContext(element, self,
+                              self.inside_table or (tag == 'table'),
+                              self.inside_float or (tag in FLOAT_TAGS),
+                              self.section_depth + (tag == 'section'),
+                              self.inside_latex or (tag == 'latex'),
+                              TableModel(element) if tag == 'table' else self.table)
+
+def element_context(element):
+    '''Return the context of element.
+
+    While a document is converted the context of the element being
+    converted is kept in conversion_state; other elements have theirs
+    made from their ancestors.
+    '''
+    context = getattr(conversion_state, 'context', None)
+    if context is not None:
+        if context.element is element:
+            return context
+        parent = element.getparent()
+        if context.element is parent:
+            return context.enter(element)
+        # a table converts its cells itself; the rows and row groups in
+        # between do not change the context
+        while (parent is not None) and (parent.tag in TABLE_PART_TAGS):
+            parent = parent.getparent()
+            if context.element is parent:
+                return context.enter(element)
+    context = ElementContext()
+    for ancestor in reversed(list(element.iterancestors())):
+        context = context.enter(ancestor)
+    return context.enter(element)
 
 
 # Templates for each class here.
@@ -322,192 +1234,179 @@ def delegate(element):
     except AttributeError:
         warning_message("Could not determine tag of element: %s"%(repr(element)))
 
-    if element.tag == 'div':
-        if 'class' not in element.attrib:
-            element.attrib['class'] = ''
-
-        if element.attrib['class'] == 'keyconcepts':
-            myElement = div_keyconcepts(element)
-        
-        elif element.attrib['class'] == 'keyquestions':
-            myElement = div_keyquestions(element)
-
-        elif element.attrib['class'] == 'question':
-            myElement = div_question(element)
-
-        elif element.attrib['class'] == 'example':
-            myElement = div_example(element)
-
-        elif element.attrib['class'] == 'casestudy':
-            myElement = div_casestudy(element)
-
-        elif element.attrib['class'] == 'exproblem':
-            myElement = div_exproblem(element)
-
-        elif element.attrib['class'] == 'exsolution':
-            myElement = div_exsolution(element)
-        
-        elif element.attrib['class'] == 'answer':
-            myElement = div_answer(element)
-
-        elif element.attrib['class'] == 'investigation':
-            myElement = div_investigation(element)
-        
-        elif element.attrib['class'] == 'activity':
-            myElement = div_activity(element)
-        
-        elif element.attrib['class'] == 'newwords':
-            myElement = div_newwords(element)
-
-        elif element.attrib['class'] == 'didyouknow':
-            myElement = div_didyouknow(element)
-
-        elif element.attrib['class'] == 'questions':
-            myElement = div_questions(element)
-
-        elif element.attrib['class'] == 'project':
-            myElement = div_project(element)
-
-        elif element.attrib['class'] == 'aside':
-            myElement = div_aside(element)
-
-        elif element.attrib['class'] == 'note':
-            myElement = div_note(element)
-
-        elif element.attrib['class'] == 'warning':
-            myElement = div_warning(element)
-
-        elif element.attrib['class'] == 'teachersguide':
-            myElement = div_teachersguide(element)
-
-        elif element.attrib['class'] == 'visit':
-            myElement = div_visit(element)
-        
-        elif 'investigation-' in element.attrib['class']:
-            myElement = div_investigation_header(element)
-        
-        elif 'activity-' in element.attrib['class']:
-            myElement = div_investigation_header(element)
-        
-        else:
-            myElement = html_element(element)
-
-    elif element.tag == 'table':
-        myElement = table(element)
-
-    elif element.tag == 'img':
-        myElement = img(element)
-    elif element.tag == 'a':
-        myElement = a(element)
-    
-    elif element.tag == 'h1':
-        if 'class' not in element.attrib:
-            element.attrib['class'] = ''
-        elif element.attrib['class'] == '':
-            myElement = html_element(element)
-        elif element.attrib['class'] == 'part':
-            myElement = part(element)
-        elif element.attrib['class'] == 'chapter':
-            myElement = html_element(element)
+    if isinstance(element, etree._Comment):
+        return '' # skip XML comments
 
+    # The tree is converted without recursion, so that deeply nested input
+    # cannot hit the recursion limit.  The stack holds, for each element
+    # being converted, its handler, an iterator over the children still to
+    # do and the LaTeX of the children done so far.
+    previous = getattr(conversion_state, 'context', None)
+    profile = active_converter().profile
+    depth = profile.depth() if profile is not None else 0
+    try:
+        if profile is not None:
+            profile.start(element)
+        handler = start_handler(element)
+        stack = [(handler, iter(handler.children()), [])]
+        while True:
+            handler, children, fragments = stack[-1]
+            for child in children:
+                if isinstance(child, etree._Comment):
+                    continue # skip XML comments
+                conversion_state.context = handler.context
+                if profile is not None:
+                    profile.start(child)
+                childHandler = start_handler(child)
+                stack.append((childHandler, iter(childHandler.children()), []))
+                break
+            else:
+                # all the children are done
+                stack.pop()
+                handler.add_children(fragments)
+                handler.finish()
+                if profile is None:
+                    latex = handler.render()
+                else:
+                    # a table converts its rows as it renders them
+                    childSeconds = profile.child_seconds()
+                    start = time.time()
+                    latex = handler.render()
+                    profile.stop(latex, time.time() - start - (profile.child_seconds() - childSeconds))
+                if len(stack) == 0:
+                    return latex
+                stack[-1][2].append(latex)
+    finally:
+        conversion_state.context = previous
+        if profile is not None:
+            # an exception leaves the elements being converted unfinished
+            profile.unwind(depth)
+
+def start_handler(element):
+    '''Make the handler of element, with the context of the element's
+    descendants set up for the handler's own conversions (e.g. titles).'''
+    conversion_state.context = element_context(element)
+    return find_handler(element)(element)
+
+def delegate_pieces(element, write):
+    '''Convert element like delegate, passing its LaTeX to write.
+
+    Tables and the sections around them are written in pieces: a table
+    converts and writes its rows one at a time, and a section writes the
+    LaTeX of its children as they are converted.  So the LaTeX of a long
+    table is never held in memory whole.
+    '''
+    if isinstance(element, etree._Comment):
+        return
+    if not find_handler(element).streamable:
+        write(delegate(element))
+        return
+    previous = getattr(conversion_state, 'context', None)
+    profile = active_converter().profile
+    depth = profile.depth() if profile is not None else 0
+    try:
+        if profile is None:
+            start_handler(element).write_pieces(write)
         else:
-            myElement = html_element(element)
-
-    #
-    # cnxmlplus tags 
-    #
-    elif  element.tag == 'note':
-        myElement = note(element)
-    elif element.tag == 'activity':
-        myElement = activity(element)
-    elif element.tag == 'link':
-        myElement = link(element)
-    elif element.tag == 'section':
-        myElement = section(element)
-    elif element.tag == '{http://www.w3.org/1998/Math/MathML}math':
-        myElement = math(element)
-    elif element.tag == 'worked_example':
-        myElement = worked_example(element)
-    elif element.tag == 'workstep':
-        myElement = workstep(element)
-    elif element.tag == 'list':
-        myElement = listelement(element)
-    elif element.tag == 'definition':
-        myElement = definition(element)
-    elif element.tag == 'figure':
-        myElement = figure(element)
-    elif element.tag == 'exercises':
-        myElement = exercises(element)
-    elif element.tag == 'exercise':
-        myElement = exercise(element)
-    elif element.tag in ['latex', 'chem_compound', 'spec_note']:
-        myElement = latex(element)
-    elif element.tag in ['pspicture', 'tikzpicture']:
-        myElement = pstikzpicture(element)
-    elif element.tag == 'image':
-        myElement = image(element)
-
-    elif isinstance(element, etree._Comment):
-        myElement = None # skip XML comments
-    else:
-        # no special handling required
-        myElement = html_element(element)
+            sizes = []
+            def write_counted(latex):
+                sizes.append(len(latex.encode('utf-8')) if isinstance(latex, unicode) else len(latex))
+                write(latex)
+            profile.start(element)
+            renderSeconds = start_handler(element).write_pieces(write_counted)
+            profile.stop(None, renderSeconds, sum(sizes))
+    finally:
+        conversion_state.context = previous
+        if profile is not None:
+            profile.unwind(depth)
+
+
+class ElementContent(dict):
+    '''The content of an element that is passed to its template.
+
+    Besides the keys set by the handler, it has the attributes of the
+    element, the escaped tag and the class (empty if there is none), but
+    these are only looked up when they are used.
+    '''
+    __slots__ = ('element',)
 
-    try:
-        myElement
-    except NameError:
-        error_message("Error with element!! %s\n\n"%etree.tostring(element), terminate=False)
-        return ''
+    def __init__(self, element):
+        dict.__init__(self)
+        self.element = element
 
-    if myElement is None:
-        return ''
-    else:
-        return myElement.render()
+    def __missing__(self, key):
+        attrib = self.element.attrib
+        if key in attrib:
+            return attrib[key]
+        if key == 'tag':
+            return escape_latex(self.element.tag)
+        if key == 'class':
+            return ''
+        raise KeyError(key)
 
 
 class html_element(object):
+    '''Convert an element to LaTeX with a template.
+
+    Conversion goes in phases, driven by delegate: __init__ sets up the
+    content (and may convert and remove parts of the element, such as its
+    title), the children are converted and added to the content (by default
+    to content['text']), then finish completes the content and render
+    applies the template.
+    '''
+    # One of these is made for every element, so keep them small. Subclasses
+    # get an instance dict, but it stays unallocated as long as they only
+    # set these attributes.
+    __slots__ = ('element', 'converter', 'context', 'content', 'template')
+
+    # The template for the element, if it does not depend on the element.
+    # Otherwise the template for the tag is used, unless template_file
+    # chooses one.
+    template_name = None
+
+    # Whether delegate_pieces writes the element with write_pieces
+    streamable = False
+
     def __init__(self, element):
         self.element = element
+        self.converter = active_converter()
+        self.context = element_context(element)
         
-        # we make a general dict to store the contents we send to the Jinja templates.
-        self.content = {}
-        self.content['text'] = self.element.text if self.element.text is not None else ''
+        # we make a general dict to store the contents we send to the Jinja
+        # templates. The tag, class and attributes are only looked up if a
+        # template asks for them.
+        self.content = ElementContent(element)
+        attrib = element.attrib
+        text = self.element.text if self.element.text is not None else ''
         tail = self.element.tail if self.element.tail is not None else ''
         if (len(tail) > 0) and (tail[0] in [' \t\r\n']):
             tail = ' ' + tail.lstrip()
         if (len(tail) > 0) and (tail[-1] in [' \t\r\n']):
             tail = tail.rstrip() + ' '
-        self.content['tail'] = tail
- 
-        self.content['tag'] = escape_latex(self.element.tag)
-
-        try:
-            self.content['class'] = self.element.attrib['class']
-        except KeyError:
-            self.content['class'] = ''
+        # attributes called text or tail take their place
+        if 'text' in attrib:
+            text = attrib['text']
+        if 'tail' in attrib:
+            tail = attrib['tail']
         
-        try:
-            self.template = texenv.get_template(self.element.tag + '.tex')
-        except TemplateNotFound:
-            self.template = texenv.get_template('not_implemented.tex')
-        except TypeError:
+        templateName = self.template_file()
+        if templateName is not None:
+            self.template = self.converter.get_template(templateName)
+        elif isinstance(self.element.tag, basestring):
+            self.template = self.converter.tag_template(self.element.tag)
+        else:
             error_message("Error in element: " + repr(element), terminate=False)
-            self.template = texenv.get_template('error.tex')
-
-        for a in self.element.attrib:
-            self.content[a] = self.element.attrib[a]
+            self.template = self.converter.get_template('error.tex')
 
         #escape latex characters
+        self.content['text'] = escape_latex(clean(text))
+        self.content['tail'] = escape_latex(tail)
 
-        self.content['text'] = clean(self.content['text'])
-        self.content['text'] = escape_latex(self.content['text'])
-        self.content['tail'] = escape_latex(self.content['tail'])
+    def template_file(self):
+        '''Return the name of the template for the element, or None for the
+        template named after its tag.'''
+        return self.template_name
 
-        self.content['text'] = clean(self.content['text'])
-
-        self.render_children()
-
-        
     def render(self):
         # return an empty string if the content is empty
 #        if self.content['text'].strip() == '':
@@ -515,57 +1414,64 @@ class html_element(object):
 #        else:
             return self.template.render(content=self.content)
 
-    def render_children(self):
-        for child in self.element:
-            self.content['text'] += delegate(child)
+    def children(self):
+        '''Return the elements whose LaTeX is added to the content.'''
+        return self.element
+
+    def add_children(self, fragments):
+        '''Add the LaTeX of the children, in order, to the content.'''
+        self.content['text'] += ''.join(fragments)
+
+    def write_pieces(self, write):
+        '''Convert the children and pass the LaTeX of the element to write,
+        in the pieces the template renders it in.  Returns the seconds spent
+        rendering, not counting write or the elements converted meanwhile.'''
+        conversion_state.context = self.context
+        self.add_children([delegate(child) for child in self.children()
+                           if not isinstance(child, etree._Comment)])
+        self.finish()
+        profile = self.converter.profile
+        childSeconds = profile.child_seconds() if profile is not None else 0.0
+        seconds = 0.0
+        start = time.time()
+        for latex in self.template.generate(content=self.content):
+            seconds += time.time() - start
+            write(latex)
+            start = time.time()
+        seconds += time.time() - start
+        if profile is not None:
+            # leave out the rows a table converts as it renders them
+            seconds -= profile.child_seconds() - childSeconds
+        return seconds
+
+    def finish(self):
+        '''Complete the content once the children have been converted.'''
+        pass
 
     def remove_empty(self):
         '''Must remove empty tags'''
         pass
 
+@register(MATHML_TAG)
 class math(html_element):
-    def __init__(self, element):
-        html_element.__init__(self, element)
-        # call the xslt transform to transform mathml to latex.
-        xslt = etree.parse(os.path.dirname(os.path.realpath(__file__)) + '/templates/xslt/mmltex.xsl')
-        transform = etree.XSLT(xslt)
-        tex = transform(element)
-        tex = unicode(tex).replace('$', '')
-        self.template = texenv.get_template('math.tex')
-        text = escape_latex(tex) 
-        # fix some things
-        text = text.replace('\&', '&')
-       
-        # fix the autosizing bracket issue. Must have matching brackets in every math environment.
-        # If they don't match, remove the autosizing \left and \right
-        if text.count('\\left') != text.count('\\right'):
-            text = text.replace('\\left', '').replace('\\right', '')
-
-        # mathml tables with display
-        self.content['text'] = text
-        
-        # replace the stackrel{^} with hat
-        text = text.replace(r'\stackrel{^}', '\hat')
-
-        #fix the trig functions too
-        trigfunctions = ['sin', 'cos', 'tan', 'cot']
-
-        # fix the \times symbol
-        text = text.replace(u'×', u' \\times ')
-
-        for tf in trigfunctions:
-            text = text.replace(' ' + tf, "\\" + tf + ' ')
-
-
+    template_name = 'math.tex'
+    def children(self):
+        # The MathML children are converted as a whole by the stylesheet
+        return []
+
+    def finish(self):
+        # call the xslt transform to transform mathml to latex
+        text = self.converter.math_to_latex(self.element)
         self.content['text'] = text
 
+@register('latex', 'chem_compound', 'spec_note')
 class latex(html_element):
-    def __init__(self, element):
+    def finish(self):
         # align, align*, equation, equation*, eqnarray, eqnarray*
         #import pdb
         #pdb.set_trace()
 
-        html_element.__init__(self, element)
+        element = self.element
         text = unescape_latex(self.content['text'].strip()) # Undo escaping since this is already latex
 
         attribDisplay = element.attrib.get('display', 'inline')
@@ -585,14 +1491,6 @@ class latex(html_element):
         else:
             raise ValueError, "Unknown value for 'display' attribute in <latex> element: " + repr(attribDisplay)
 
-        # possible issue with $$ $$ or \[ \] modes inside a tabular.
-        # test that by changing to $ $ mode
-        ancestors = [a for a in element.iterancestors()]
-        inside_table = ['table' in a for a in ancestors]
-        if any(inside_table):
-            text = text.replace(r'\[', r'\(')
-            text = text.replace(r'\]', r'\)')
-
         # CNXML+ files sometimes have open lines inside <latex> tags. Remove them.
         lines = text.split('\n')
         text = '\n'.join([l for l in lines if len(l.strip()) > 0])
@@ -602,6 +1500,7 @@ class latex(html_element):
 
         self.content['text'] = text
 
+@register('pspicture', 'tikzpicture')
 class pstikzpicture(html_element):
     def __init__(self, element):
         codeElement = element.find('code')
@@ -610,20 +1509,25 @@ class pstikzpicture(html_element):
         for child in codeElement.getchildren():
             element.append(child)
         html_element.__init__(self, element)
+
+    def finish(self):
         self.content['text'] = unescape_latex(self.content['text'].strip()) # Undo escaping since this is already latex
 
 
+@register('worked_example')
 class worked_example(html_element):
+    template_name = 'worked_example.tex'
     def __init__(self, element):
         title = element.find('.//title')
         titletext = delegate(title)
         element.remove(title)
         html_element.__init__(self, element)
-        self.template = texenv.get_template('worked_example.tex')
         self.content['title'] = titletext
 
 
+@register('note')
 class note(html_element):
+    template_name = 'note.tex'
     def __init__(self, element):
         html_element.__init__(self, element)
 
@@ -632,9 +1536,10 @@ class note(html_element):
         else:
             self.content['type'] = 'note'
 
-        self.template = texenv.get_template('note.tex')
 
+@register('activity')
 class activity(html_element):
+    template_name = 'activity.tex'
     def __init__(self, element):
          
         title = element.find('.//title')
@@ -653,29 +1558,35 @@ class activity(html_element):
             self.content['type'] = 'activity'
        
 
-        self.template = texenv.get_template('activity.tex')
 
 
 
+@register('link')
 class link(html_element):
-    def __init__(self, element):
-        html_element.__init__(self, element)
+    def template_file(self):
+        attributes = self.element.attrib
+        if ('url' not in attributes) and ('target-id' in attributes):
+            return 'link-reference.tex'
+        return None
+
+    def finish(self):
+        element = self.element
         # make it a url if the 'href' attribute is set
         attributes = element.attrib.keys()
         if 'url' in attributes:
             self.content['url'] = escape_latex(element.attrib['url'])
         elif 'target-id' in attributes:
             self.content['target_id'] = escape_latex(element.attrib['target-id'])
-            self.template = texenv.get_template('link-reference.tex')
         else:
             self.content['url'] = escape_latex(self.content['text'])
 
 
 
 
+@register('a')
 class a(html_element):
-    def __init__(self, element):
-        html_element.__init__(self, element)
+    def finish(self):
+        element = self.element
         # make it a url if the 'href' attribute is set
         if 'href' in element.attrib.keys():
             self.content['url'] = element.attrib['href']
@@ -685,7 +1596,9 @@ class a(html_element):
 
 
 
+@register('definition')
 class definition(html_element):
+    template_name = 'definition.tex'
     def __init__(self, element):
         term = element.find('.//term')
         termtext = delegate(term)
@@ -694,30 +1607,31 @@ class definition(html_element):
         meaningtext = delegate(meaning)
         element.remove(meaning)
         html_element.__init__(self, element)
-        self.template = texenv.get_template('definition.tex')
         self.content['term'] = termtext
         self.content['meaning'] = meaningtext
 
+@register('figure')
 class figure(html_element):
+    template_name = 'figure.tex'
     def __init__(self, element):
         
-        # Check if the parent is a floating environment, can't nest them.
-        floats = ['exercise', 'worked_example', 'activity', 'exercises']
-        ancestors = [a for a in element.iterancestors()]
-        inside_float = any([a.tag in floats for a in ancestors])
-        # basically a floating environment
+        # basically a floating environment. Floats can't be nested, so
+        # self.context.inside_float tells whether the figure can float.
         type_element = element.find('.//type')
         typetext = 'figure'
         if type_element is not None:
             typetext = type_element.text 
             element.remove(type_element)
         html_element.__init__(self, element)
-        self.template = texenv.get_template('figure.tex')
         self.content['type'] = typetext
+
+    def finish(self):
         self.content['text'] = self.content['text'].replace(r'\par', '')
 
 
+@register('exercise')
 class exercise(html_element):
+    template_name = 'exercise.tex'
     def __init__(self, element):
         title = element.find('.//title')
         if title is not None:
@@ -725,10 +1639,11 @@ class exercise(html_element):
             element.remove(title)
         else: titletext = ""
         html_element.__init__(self, element)
-        self.template = texenv.get_template('exercise.tex')
         self.content['title'] = titletext
 
+@register('exercises')
 class exercises(html_element):
+    template_name = 'exercise.tex'
     def __init__(self, element):
         title = element.find('.//title')
         titletext = None
@@ -741,69 +1656,95 @@ class exercises(html_element):
             e.tag = 'ex_entry'
 
         html_element.__init__(self, element)
-        self.template = texenv.get_template('exercise.tex')
         if titletext is not None:
             self.content['title'] = titletext
 
 
+@register('workstep')
 class workstep(html_element):
+    template_name = 'workstep.tex'
     def __init__(self, element):
         title = element.find('.//title')
         titletext = delegate(title)
         element.remove(title)
         html_element.__init__(self, element)
-        self.template = texenv.get_template('workstep.tex')
         self.content['title'] = titletext
 
+@register('list')
 class listelement(html_element):
-    def __init__(self, element):
-        html_element.__init__(self, element)
+    def template_file(self):
         try:
-            list_type = element.attrib['list-type']
+            list_type = self.element.attrib['list-type']
         except KeyError:
             list_type = 'bulleted'
 
         if list_type == 'enumerated':
-            self.template = texenv.get_template('enumerated.tex')
+            return 'enumerated.tex'
         elif list_type == 'bulleted':
-            self.template = texenv.get_template('bulleted.tex')
+            return 'bulleted.tex'
         else:
-            self.template = texenv.get_template('not_implemented.tex')
+            return 'not_implemented.tex'
 
 
 
+@register('section')
 class section(html_element):
+    streamable = True
     def __init__(self, element):
         title = element.find('.//title')
         titletext = delegate(title)
         element.remove(title)
         html_element.__init__(self, element)
+        self.content['title'] = titletext
 
+    def template_file(self):
         sectiondepth = {0:'chapter', 1:'section', 2:'subsection', 3:'subsubsection', 4:'textbf'}
         try:
-            self.template = texenv.get_template('%s.tex'%element.attrib['type'])
+            return '%s.tex'%self.element.attrib['type']
         except KeyError:
-            # find the depth of the section.
-            depth = 0
-            for a in element.iterancestors():
-                if a.tag == 'section': depth += 1
-
-            self.template = texenv.get_template('%s.tex'%sectiondepth[depth])
-
-        self.content['title'] = titletext
-
+            # the depth of the section, not counting itself.
+            return '%s.tex'%sectiondepth[self.context.section_depth - 1]
+
+    # Put on both sides of the children to check that the template prints
+    # them as they are: a template that strips, escapes or otherwise edits
+    # its text would change the probe too.
+    PIECES_PROBE = u' &\\probe{}\n'
+
+    def write_pieces(self, write):
+        # write the children where the template puts them, as they are
+        # converted, if it puts them in one place and leaves them alone
+        text = self.content['text']
+        marked = self.PIECES_PROBE + LatexWriter.SENTINEL + self.PIECES_PROBE
+        start = time.time()
+        self.content['text'] = text + LatexWriter.SENTINEL
+        rendered = self.render()
+        self.content['text'] = text + marked
+        probed = self.render()
+        seconds = time.time() - start
+        self.content['text'] = text
+        parts = rendered.split(LatexWriter.SENTINEL)
+        if (len(parts) != 2) or (probed != rendered.replace(LatexWriter.SENTINEL, marked)):
+            return html_element.write_pieces(self, write)
+        write(parts[0])
+        for child in self.children():
+            conversion_state.context = self.context
+            delegate_pieces(child, write)
+        write(parts[1])
+        return seconds
+
+@register('h1', css_class='part')
 class part(html_element):
+    template_name = 'part.tex'
     def __init__(self, element):
         r'''Convert the h1.part element to LaTeX
 
 '''
         html_element.__init__(self, element)
-        self.template = texenv.get_template('part.tex')
 
 
 class unitnumber(html_element):
-    def __init__(self, element):
-        html_element.__init__(self, element)
+    def finish(self):
+        element = self.element
 
         # United numbers: ensure that units follow numbers
         for node in element:
@@ -815,135 +1756,200 @@ class unitnumber(html_element):
                 node.append(numberNode)
                 node.append(unitNode)
 
-class table(html_element):
-    def __init__(self, element):
-        html_element.__init__(self, element)
-        # check whether its html or cnxml table
-        if element.find('.//tr') is not None:
-            # html table
-            # must get number of columns. # find maximum number of td elements in a single row
-            max_td = 0
-            for row in element.findall('.//tr'):
-                ncols = len(row.findall('.//td'))
-                max_td = max([max_td, ncols])
-                ncols = len(row.findall('.//th'))
-                max_td = max([max_td, ncols])
-
-            self.content['ncols'] = max_td
-            ncols = max_td
-            
-            # try a fancy column specifier for longtable
-            colspecifier = r">{\centering}p{%1.3f\textwidth}"%(float(0.85/ncols))
-            self.content['cols'] = '|' + '|'.join([colspecifier for i in range(int(ncols))]) + '|'
-            self.content['text'] = self.content['text'].replace(r'& \\ \hline', r'\tabularnewline \hline')
-            self.content['text'] = self.content['text'].replace('\\par', ' ')
-            self.content['text'] = self.content['text'].replace('\n','').replace('\\hline','\hline\n')
-            #self.content['text'] = ''
+def replace_in_pieces(pieces, old, new):
+    '''Yield the text made of pieces with old replaced by new, as
+    text.replace(old, new) would.  The end of each piece that may be the
+    start of old is held back until the next piece comes.'''
+    keep = len(old) - 1
+    text = ''
+    for piece in pieces:
+        text += piece
+        parts = []
+        position = 0
+        while True:
+            found = text.find(old, position)
+            if (found < 0) or (found > len(text) - len(old)):
+                break
+            parts.append(text[position:found])
+            parts.append(new)
+            position = found + len(old)
+        end = max(position, len(text) - keep)
+        parts.append(text[position:end])
+        text = text[end:]
+        yield ''.join(parts)
+    yield text.replace(old, new)
+
+def strip_pieces(pieces):
+    '''Yield the text made of pieces without the whitespace it starts and
+    ends with, as text.strip() would.'''
+    started = False
+    space = ''
+    for piece in pieces:
+        if not started:
+            piece = piece.lstrip()
+            started = len(piece) > 0
+        stripped = piece.rstrip()
+        if len(stripped) > 0:
+            yield space + stripped
+            space = piece[len(stripped):]
         else:
-            #cnxml table
-            # must get number of columns. # find maximum number of td elements in a single row
-            max_td = 0
-            for row in element.findall('.//row'):
-                ncols = len(row.findall('.//entry'))
-                max_td = max([max_td, ncols])
-
-            self.content['ncols'] = max_td
-            ncols = max_td
-            
-            if 'latex-column-spec' in element.attrib:
-                self.content['columnspec'] = element.attrib['latex-column-spec']
-            elif element.find('.//tgroup') is not None:
-
-                colspecifier = r">{\raggedright}p{%1.3f\textwidth}"%(float(0.85/ncols))
-                self.content['columnspec'] = '|' + '|'.join([colspecifier for i in range(int(ncols))]) + '|'
-#               tgroup = element.find('.//tgroup')
-#            #  if 'cols' in tgroup.attrib:
-#            #      ncols = int(tgroup.attrib['cols'])
-#            #      self.content['columnspec'] = '|c'*ncols + '|'
-#            #  else:
-#               ncols = len(element.find('.//row').findall('.//entry'))
-#               self.content['columnspec'] = '|c'*ncols + '|'
-            # remove the last & in the row.
-
-            # fix some stuff
-
-            self.content['text'] = self.content['text'].replace(r'& \\', r' \\')
-            self.content['text'] = self.content['text'].replace(r'& \tabularnewline', r' \tabularnewline')
-            text = self.content['text'] 
-            # cannot use $$ $$ or \[ \] math modes inside tabulars
-            text = text.replace('$$', '$')
-            text = text.replace('\\[', '$')
-            text = text.replace('\\]', '$')
-            text = text.replace('\\begin{center}', '').replace('\\end{center}', '')
-            text = text.replace('\\par', '')
-            text = text.replace('\n\n', '')
-
-            
-            # fix image widths if they are present
-            lines = text.split('\n')
-            new_lines = []
-            for l in lines:
-                if 'includegraphics' in l:
-                    if ncols is not None:
-                        start = ''.join(l.partition('[')[0:2])
-                        middle = r'width=%1.3f\textwidth'%(float(0.75/ncols))
-                        end = ''.join(l.rpartition(']')[-2:])
-                        l = ''.join([start, middle, end])
-
-                new_lines.append(l)
-
-            text = '\n'.join(new_lines)
-
-
-            self.content['text'] = text
-
-        
-        
-        self.template = texenv.get_template('table.tex')
-
-
-
+            space += piece
+
+def split_pieces(pieces):
+    r'''Yield the lines of the text made of pieces, as text.split('\n') would.'''
+    line = ''
+    for piece in pieces:
+        lines = (line + piece).split('\n')
+        line = lines.pop()
+        for complete in lines:
+            yield complete
+    yield line
+
+# The edits that turn the LaTeX of what a table holds into the body of a
+# longtable, made one after the other.  Every html cell ends with &, which
+# must go after the last cell of a row, and each row is put on one line.
+HTML_TABLE_EDITS = [
+    (r'& \\ \hline', r'\tabularnewline \hline'),
+    ('\\par', ' '),
+    ('\n', ''),
+    ('\\hline', '\\hline\n'),
+    # the last cell of every row still ends with &
+    (r'& \\ \hline', r'\\ \hline'),
+]
+# cnxmlplus rows end with \tabularnewline, and the cells cannot use
+# paragraphs, display maths or centring
+CNXMLPLUS_TABLE_EDITS = [
+    (r'& \\', r' \\'),
+    (r'& \tabularnewline', r' \tabularnewline'),
+    ('$$', '$'),
+    ('\\[', '$'),
+    ('\\]', '$'),
+    ('\\begin{center}', ''),
+    ('\\end{center}', ''),
+    ('\\par', ''),
+    ('\n\n', ''),
+]
+
+class TableLines(object):
+    '''The LaTeX of the rows of a table for its template, made a row at a
+    time when the template gets to it, so that a table rendered in pieces
+    is never in memory whole.  The html templates get the rows a line at
+    a time, the cnxmlplus ones get them in pieces, stripped.  Converting
+    changes the tree (handlers remove titles and the like), so the lines
+    can only be iterated over once.
+    '''
+    def __init__(self, handler):
+        self.handler = handler
+        self.context = handler.context
+        self.model = handler.context.table
+        self.iterated = False
+        # the lines, if they had to be made to tell whether there are any
+        self.lines = None
+
+    def __nonzero__(self):
+        # Each row gives a line.  Without rows, the table only has
+        # something to write if what it holds is not blank.
+        if self.model.rows > 0:
+            return True
+        if self.lines is None:
+            self.lines = list(self.convert())
+        return ''.join(self.lines).strip() != ''
+
+    def __iter__(self):
+        if self.iterated:
+            raise RuntimeError('the rows of a table can only be iterated over once')
+        self.iterated = True
+        if self.lines is not None:
+            return iter(self.lines)
+        return self.convert()
+
+    def convert(self):
+        '''Convert what the table holds, yielding the lines.'''
+        pieces = self.pieces()
+        if self.model.html:
+            edits = HTML_TABLE_EDITS
+        else:
+            edits = CNXMLPLUS_TABLE_EDITS
+        for old, new in edits:
+            pieces = replace_in_pieces(pieces, old, new)
+        # the html templates write a line at a time
+        if self.handler.converter.templateSet == 'html':
+            return split_pieces(pieces)
+        return strip_pieces(pieces)
+
+    def pieces(self):
+        '''Yield the LaTeX of what the table holds, in document order.'''
+        yield self.handler.content['text']
+        for kind, element in self.model.items:
+            conversion_state.context = self.context
+            if kind == 'row':
+                yield self.row(element)
+            elif kind == 'start':
+                # a row group is passed through, like the rows' parent
+                yield escape_latex(clean(element.text or ''))
+            elif kind == 'end':
+                yield escape_latex(element.tail or '')
+            else:
+                yield delegate(element)
+
+    def row(self, element):
+        '''Return the LaTeX of a row, converting its cells.'''
+        text = escape_latex(clean(element.text or ''))
+        for cell in element:
+            if not isinstance(cell, etree._Comment):
+                conversion_state.context = self.context
+                text += delegate(cell)
+        tail = escape_latex(element.tail or '')
+        if self.model.html:
+            return text.lstrip() + tail.rstrip() + ' \\\\ \\hline\n'
+        return text.strip() + tail.strip() + ' \\tabularnewline \\hline\n'
+
+@register('table')
+class table(html_element):
+    '''An html or cnxmlplus table, converted to a longtable.
+
+    The column count comes from the TableModel of the table's context.
+    The rows are converted as the template writes them (see TableLines),
+    so that delegate_pieces can write a long table a row at a time.
+    '''
+    template_name = 'table.tex'
+    streamable = True
+    def children(self):
+        # the rows, and whatever else the table holds, come from TableLines
+        return []
+
+    def finish(self):
+        model = self.context.table
+        self.content['ncols'] = model.ncols
+        if model.html:
+            self.content['cols'] = model.column_spec(r'\centering')
+        elif 'latex-column-spec' in self.element.attrib:
+            self.content['columnspec'] = self.element.attrib['latex-column-spec']
+        elif model.tgroup:
+            self.content['columnspec'] = model.column_spec(r'\raggedright')
+        self.content['lines'] = TableLines(self)
+
+
+@register('img')
 class img(html_element):
+    template_name = 'img.tex'
     def __init__(self, element):
-        image_types = {'JPEG':'.jpg', 'PNG':'.png', 'GIF':'.gif'}
         html_element.__init__(self, element)
-        # get the link to the image and download it.
-        src = element.attrib['src']
-        name = src.rpartition('/')[-1]
-        self.content['imagename'] = src
-        self.template = texenv.get_template('img.tex')
-        
-#       try:
-#           downloaded = any([name in imname for imname in os.listdir(os.curdir + '/images')])
-#       except OSError:
-#           try:
-#               downloaded = any([name in imname for imname in os.listdir(os.curdir + '/')])
-#           except OSError:
-#               downloaded = False
-#           downloaded = False
-
-#       if not downloaded: 
-#           try:
-#               img = urllib.urlopen(src).read()
-#               open('images/%s'%name, 'wb').write(img)
-#               # now open the file and read the mimetpye
-#               try:
-#                   im = Image.open('images/%s'%name)
-#                   extension = image_types[im.format]
-#                   os.system('mv images/%s images/%s'%(name, name+extension))
-#                   # update the image name that the template will see
-#                   self.content['imagename'] = name + extension
-#               except:
-#                   print "Cannot open image: %s"%name
-
-#           except IOError:
-#               print "Image %s not found at %s" % (name, src)
+        # the source may have been replaced by a local copy, see
+        # Converter.fetch_images
+        self.content['imagename'] = element.attrib['src']
 
 
+@register('image')
 class image(html_element):
     def __init__(self, element):
         html_element.__init__(self, element)
-        specifier = 'width=0.8\\textwidth'
+        table = self.context.table
+        if table is None:
+            specifier = 'width=0.8\\textwidth'
+        else:
+            # fit the image in its column
+            specifier = 'width=%1.3f\\textwidth'%table.image_width()
         self.content['specifier'] = specifier
         src = element.find('.//src')
         if src is not None:
@@ -957,7 +1963,9 @@ class image(html_element):
 #               self.content['specifier'] = r'width=%1.2fin, height=%1.2fin'%(width, height)
 
 
+@register('div', css_class='keyconcepts')
 class div_keyconcepts(html_element):
+    template_name = 'keyconcepts.tex'
     def __init__(self, element):
         r'''Convert the div.keyconcepts element to LaTeX
 
@@ -967,117 +1975,131 @@ class div_keyconcepts(html_element):
         u'\n\\keyconcepts{}\n'
 '''
         html_element.__init__(self, element)
-        self.template = texenv.get_template('keyconcepts.tex')
 
 
+@register('div', css_class='keyquestions')
 class div_keyquestions(html_element):
+    template_name = 'keyquestions.tex'
     def __init__(self, element):
         r'''convert the div.keyquestions element to latex
 
 '''
         html_element.__init__(self, element)
-        self.template = texenv.get_template('keyquestions.tex')
 
+@register('div', css_class='aside')
 class div_aside(html_element):
+    template_name = 'aside.tex'
     def __init__(self, element):
         r'''convert the div.aside element to latex
 
 '''
         html_element.__init__(self, element)
-        self.template = texenv.get_template('aside.tex')
 
+@register('div', css_class='note')
 class div_note(html_element):
+    template_name = 'note.tex'
     def __init__(self, element):
         r'''convert the div.note element to latex
 
 '''
         html_element.__init__(self, element)
-        self.template = texenv.get_template('note.tex')
 
+@register('div', css_class='warning')
 class div_warning(html_element):
+    template_name = 'warning.tex'
     def __init__(self, element):
         r'''convert the div.warning element to latex
 
 '''
         html_element.__init__(self, element)
-        self.template = texenv.get_template('warning.tex')
 
+@register('div', css_class='casestudy')
 class div_casestudy(html_element):
+    template_name = 'casestudy.tex'
     def __init__(self, element):
         r'''convert the div.casestudy element to latex
 
 '''
         html_element.__init__(self, element)
-        self.template = texenv.get_template('casestudy.tex')
 
+@register('div', css_class='visit')
 class div_visit(html_element):
+    template_name = 'visit.tex'
     def __init__(self, element):
         r'''convert the div.visit element to latex
 
 '''
         html_element.__init__(self, element)
-        self.template = texenv.get_template('visit.tex')
 
+@register('div', css_class='didyouknow')
 class div_didyouknow(html_element):
+    template_name = 'didyouknow.tex'
     def __init__(self, element):
         r'''convert the div.didyouknow element to latex
 
 '''
         html_element.__init__(self, element)
-        self.template = texenv.get_template('didyouknow.tex')
 
         
+@register('div', css_class='project')
 class div_project(html_element):
+    template_name = 'project.tex'
     def __init__(self, element):
         r'''convert the div.project element to latex
 
 '''
         html_element.__init__(self, element)
-        self.template = texenv.get_template('project.tex')
 
+@register('div', css_class='questions')
 class div_questions(html_element):
+    template_name = 'questions.tex'
     def __init__(self, element):
         r'''convert the div.questions element to latex
 
 '''
         html_element.__init__(self, element)
-        self.template = texenv.get_template('questions.tex')
 
 
+@register('div', css_class='answer')
 class div_answer(html_element):
+    template_name = 'answer.tex'
     def __init__(self, element):
         r'''convert the div.answer element to latex
 
 '''
         html_element.__init__(self, element)
-        self.template = texenv.get_template('answer.tex')
 
+@register('div', css_class='example')
 class div_example(html_element):
+    template_name = 'example.tex'
     def __init__(self, element):
         r'''convert the div.example element to latex
 
 '''
         html_element.__init__(self, element)
-        self.template = texenv.get_template('example.tex')
 
+@register('div', css_class='exproblem')
 class div_exproblem(html_element):
+    template_name = 'exproblem.tex'
     def __init__(self, element):
         r'''convert the div.exproblem element to latex
 
 '''
         html_element.__init__(self, element)
-        self.template = texenv.get_template('exproblem.tex')
 
 
+@register('div', css_class='exsolution')
 class div_exsolution(html_element):
+    template_name = 'exsolution.tex'
     def __init__(self, element):
         r'''convert the div.exsolution element to latex
 
 '''
         html_element.__init__(self, element)
-        self.template = texenv.get_template('exsolution.tex')
 
+@register('div', css_class='question')
 class div_question(html_element):
+    template_name = 'question.tex'
     def __init__(self, element):
         r'''convert the div.question element to latex
 
@@ -1094,36 +2116,40 @@ class div_question(html_element):
 #           html_element.__init__(self, element)
 #           self.content['answer'] = ''
 
-        self.template = texenv.get_template('question.tex')
         
 
 
+@register('div', css_class='teachersguide')
 class div_teachersguide(html_element):
+    template_name = 'teachersguide.tex'
     def __init__(self, element):
         r'''convert the div.teachersguide element to latex
 
 '''
         html_element.__init__(self, element)
-        self.template = texenv.get_template('teachersguide.tex')
 
+@register('div', css_class='investigation')
 class div_investigation(html_element):
+    template_name = 'investigation.tex'
     def __init__(self, element):
         r'''Convert the div.investigation element to LaTeX
 
 '''
         html_element.__init__(self, element)
-        self.template = texenv.get_template('investigation.tex')
 
+@register('div', css_class='newwords')
 class div_newwords(html_element):
+    template_name = 'newwords.tex'
     def __init__(self, element):
         r'''Convert the div.newwords element to LaTeX
 
 '''
         html_element.__init__(self, element)
-        self.template = texenv.get_template('newwords.tex')
 
 
+@register('div', css_class='activity')
 class div_activity(html_element):
+    template_name = 'activity.tex'
     def __init__(self, element):
         r'''Convert the div.activity element to LaTeX
 
@@ -1141,17 +2167,18 @@ class div_activity(html_element):
             title = 'None'
         html_element.__init__(self, element)
         self.content['title'] = title 
-        self.template = texenv.get_template('activity.tex')
 
 
+@register('div', class_pattern='investigation-')
+@register('div', class_pattern='activity-')
 class div_investigation_header(html_element):
+    template_name = 'investigation_header.tex'
     def __init__(self, element):
         r'''Convert the div.investigation element to LaTeX
 
 '''
         html_element.__init__(self, element)
         self.content['title'] = self.content['class'].split('-')[1]
-        self.template = texenv.get_template('investigation_header.tex')
 
 
 
@@ -1161,6 +2188,9 @@ class div_investigation_header(html_element):
 # @param text The HTML (or XML) source text.
 # @return The plain text, as a Unicode string, if necessary.
 
+ENTITY_TABLE = dict([('&%s;'%name, unichr(codepoint)) for name, codepoint in htmlentitydefs.name2codepoint.items()])
+ENTITY_RE = re.compile(r'&#?\w+;')
+
 def unescape(text):
     def fixup(m):
         text = m.group(0)
@@ -1175,35 +2205,63 @@ def unescape(text):
                 pass
         else:
             # named entity
-            try:
-                text = unichr(htmlentitydefs.name2codepoint[text[1:-1]])
-            except KeyError:
-                pass
+            return ENTITY_TABLE.get(text, text)
         return text # leave as is
-    return re.sub("&#?\w+;", fixup, text)
+    return ENTITY_RE.sub(fixup, text)
+
+def unescape_entities(root):
+    '''Resolve the character references and entities left in the text of a tree.
+
+    These come from doubly escaped input (e.g. &amp;nbsp;); resolving them
+    as the tree is loaded means the LaTeX output needs no clean-up pass.
+    '''
+    for element in root.iter(tag=etree.Element):
+        if (element.text is not None) and ('&' in element.text):
+            element.text = unescape(element.text)
+        if (element.tail is not None) and ('&' in element.tail):
+            element.tail = unescape(element.tail)
+
+# An escaped percent sign absorbs up to two of the backslashes already in
+# front of it: k backslashes and a percent sign give max(k - 1, 1) of them.
+LATEX_ESCAPES = Translator(r'\\*%|[&#_]|\\rm', {
+    '&': r'\&', '#': r'\#', '_': r'\_', '%': r'\%',
+    # fix some stuff
+    r'\rm': r'\mathrm',
+}, fallback=lambda text: '\\'*max(len(text) - 2, 1) + '%')
 
 def escape_latex(text):
     '''Escape some latex special characters'''
-    text = text.replace(r'&', r'\&')
-    text = text.replace(r'#', r'\#')
-    text = text.replace(r'_', r'\_')
-    text = text.replace(r'%', r'\%')
-    text = text.replace(r'\\%', r'\%')
-    text = text.replace(r'\\%', r'\%')
-    # fix some stuff
-    text = text.replace(r'\rm', r'\mathrm')
-    return text
+    return LATEX_ESCAPES(text)
+
+LATEX_UNESCAPES = Translator(r'\\[%_#&]', {r'\%': '%', r'\_': '_', r'\#': '#', r'\&': '&'})
 
 def unescape_latex(text):
-    text = text.replace(r'\%', r'%')
-    text = text.replace(r'\_', r'_')
-    text = text.replace(r'\#', r'#')
-    text = text.replace(r'\&', r'&')
-    return text
+    return LATEX_UNESCAPES(text)
 
 
-def setup_texenv(loader):
-    texenv = jinja2.Environment(loader=loader)
+class TemplateBytecodeCache(jinja2.FileSystemBytecodeCache):
+    '''Jinja bytecode cache that several processes can share.
+
+    Jinja only uses a cached template if the checksum of its source still
+    matches, so edited templates are recompiled.  Files are replaced
+    atomically so that no worker reads a half written one, and a read-only
+    cache directory just means templates are compiled in memory.
+    '''
+    def dump_bytecode(self, bucket):
+        filename = self._get_cache_filename(bucket)
+        temporary = '%s.%i.%i.tmp'%(filename, os.getpid(), threading.current_thread().ident)
+        try:
+            f = open(temporary, 'wb')
+            try:
+                bucket.write_bytecode(f)
+            finally:
+                f.close()
+            os.rename(temporary, filename)
+        except (IOError, OSError):
+            pass
+
+def setup_texenv(loader, bytecodeCache=None):
+    texenv = jinja2.Environment(loader=loader, bytecode_cache=bytecodeCache)
     texenv.block_start_string = '((*'
     texenv.block_end_string = '*))'
     texenv.variable_start_string = '((('
@@ -1214,59 +2272,697 @@ def setup_texenv(loader):
 
     return texenv
 
-def clean(text):
-    text = text.replace(u'Â', ' ')
-    text = text.replace(u'â', '')
-    text = text.replace(u'â', '')
-    text = text.replace(u'''
-''', '\n')
-    text = text.replace(u'â', '\'')
-    text = text.replace(u'â', '')
-    text = text.replace(u'â', '``')
-    text = text.replace(u'â ', '\'\'')
-    text = text.replace(u'\u00a0', ' ')
-    text = text.replace(u'\u00c2', ' ')
-    return text
+# Mis-decoded UTF-8 punctuation and non-breaking spaces
+CLEAN_SUBS = Translator(u'\u00e2\u0080[\u009c\u009d\u0099\u0093]|[\u00c2\u00a0]', {
+    u'\u00c2': ' ',
+    u'\u00e2\u0080\u009c': '',
+    u'\u00e2\u0080\u009d': '',
+    u'\u00e2\u0080\u0099': '\'',
+    u'\u00e2\u0080\u0093': '',
+    u'\u00a0': ' ',
+})
 
-if __name__ == "__main__":
+def clean(text):
+    # Taking out one sequence can join the pieces of another, which the
+    # replacements one after the other used to catch, so repeat until the
+    # text stops changing
+    while True:
+        cleaned = CLEAN_SUBS(text)
+        if cleaned == text:
+            return cleaned
+        text = cleaned
+
+class LatexWriter(object):
+    '''Write a converted document to a file one top-level fragment at a time.
+
+    The fragments are placed where doc.tex prints its content.  If doc.tex
+    does more with its content than print it, the fragments are collected
+    and the template is rendered once at the end instead.
+    '''
+    SENTINEL = u'\ue001'
+
+    def __init__(self, out, template):
+        self.out = out
+        self.template = template
+        parts = template.render(content=self.SENTINEL).split(self.SENTINEL)
+        if len(parts) == 2:
+            self.prefix, self.suffix = parts
+            self.fragments = None
+        else:
+            self.prefix = self.suffix = u''
+            self.fragments = []
+        self.write_text(self.prefix)
 
-    Textbook = True
-    extension = sys.argv[1].rpartition('.')[-1]
-    filename = sys.argv[1].rpartition('.')[-3]
-    information_message(extension + ' ' + filename)
-    if extension == 'html':
-        f = open(sys.argv[1], 'r').read().decode('utf-8')
-        if f.strip() == '':
-            fout = open(sys.argv[1].replace('.html', '.tex'), 'w')
+    def write(self, fragment):
+        if self.fragments is not None:
+            self.fragments.append(fragment)
+        else:
+            self.write_text(fragment)
+
+    def close(self):
+        if self.fragments is not None:
+            self.write_text(self.template.render(content=''.join(self.fragments)))
+        self.write_text(self.suffix)
+
+    def write_text(self, text):
+        self.out.write(unicode(text).encode('utf-8'))
+
+
+TEMPLATE_DIR = os.path.dirname(os.path.realpath(__file__)) + '/templates'
+# Compiled templates written by --precompile
+TEMPLATE_CACHE_DIR = TEMPLATE_DIR + '/.cache'
+# Number of elements from which a document is worth converting in parallel
+SECTION_THRESHOLD = 5000
+# libxml2 stops at 256 levels of nesting unless it is told otherwise
+HTML_PARSER = etree.HTMLParser(huge_tree=True)
+XML_PARSER = etree.XMLParser(huge_tree=True)
+
+class Converter(object):
+    '''Convert html or cnxmlplus documents to LaTeX.
+
+    A converter owns the Jinja environment of its template set, the
+    templates loaded from it and the XSLT and MathML caches it uses.  It
+    keeps no state between conversions, so one converter can be shared by
+    the threads of a pool: the document being converted by each thread is
+    kept in conversion_state.
+
+    >>> print Converter('html').convert_string('<h1>Title</h1>')
+    \\chapter{Title}
+    '''
+    def __init__(self, templateSet='html', templateDir=None, xsltCache=None, mathCache=None,
+                 cacheDir=TEMPLATE_CACHE_DIR, fragmentCache=None, sectionJobs=1,
+                 sectionThreshold=SECTION_THRESHOLD, profile=None, assetCache=None):
+        self.templateSet = templateSet
+        if templateDir is None:
+            templateDir = TEMPLATE_DIR + '/' + templateSet
+        self.template_dir = templateDir
+        self.cache_dir = cacheDir
+        # Documents of at least sectionThreshold elements have their top-level
+        # elements converted by a pool of sectionJobs processes
+        self.section_jobs = sectionJobs
+        self.section_threshold = sectionThreshold
+        self.section_pool = None
+        self.section_pool_lock = threading.Lock()
+        # a Profile to record the conversion in, if any
+        self.profile = profile
+        # compiled templates are loaded from cacheDir if it exists
+        bytecodeCache = None
+        if (cacheDir is not None) and os.path.isdir(cacheDir):
+            bytecodeCache = TemplateBytecodeCache(cacheDir)
+        self.texenv = setup_texenv(jinja2.FileSystemLoader(templateDir), bytecodeCache)
+        # Load every template up front, so that elements look theirs up in
+        # a dict: tags without a template of their own get not_implemented.
+        self.templates = {}
+        for name in self.texenv.list_templates(extensions=['tex']):
+            self.templates[name] = self.texenv.get_template(name)
+        self.tag_templates = dict([(name[:-len('.tex')], template) for name, template in self.templates.items()])
+        self.not_implemented = self.templates['not_implemented.tex']
+        self.xslt_cache = xsltCache if xsltCache is not None else xslt_cache
+        self.math_cache = mathCache if mathCache is not None else math_cache
+        self.fragment_cache = fragmentCache if fragmentCache is not None else fragment_cache
+        self.asset_cache = assetCache if assetCache is not None else asset_cache
+        # Fragments converted by another version of the templates, of the
+        # MathML stylesheets or of this module are not reused
+        templateHash = hashlib.sha1(open(os.path.splitext(__file__)[0] + '.py', 'rb').read())
+        for name in sorted(self.templates):
+            templateHash.update(name.encode('utf-8') + '\0')
+            templateHash.update(self.texenv.loader.get_source(self.texenv, name)[0].encode('utf-8') + '\0')
+        templateHash.update(math_version(self.xslt_cache.directory))
+        self.template_hash = templateHash.hexdigest()
+
+    def get_template(self, name):
+        '''Return the template called name.'''
+        template = self.templates.get(name)
+        if template is None:
+            # Not in the template directory; Jinja raises TemplateNotFound
+            template = self.texenv.get_template(name)
+        return template
+
+    def tag_template(self, tag):
+        '''Return the template for elements called tag.'''
+        return self.tag_templates.get(tag, self.not_implemented)
+
+    def math_to_latex(self, element):
+        '''Return the LaTeX for a MathML element of the document being converted.'''
+        text = conversion_state.math.get(element)
+        if text is None:
+            text = mathml_to_latex(element, self.xslt_cache, self.math_cache)
+        return text
+
+    def parse(self, text):
+        '''Parse a document and return its root, with entities resolved.'''
+        if self.templateSet == 'html':
+            root = etree.HTML(text, HTML_PARSER)
+        else:
+            root = etree.XML(text, XML_PARSER)
+        unescape_entities(root)
+        return root
+
+    def body(self, root):
+        '''Return the element whose children make up the document.'''
+        if self.templateSet == 'html':
+            return root.find('.//body')
+        self.transform(root)
+        return root.find('.//content')
+
+    def transform(self, root, element=None):
+        '''Apply transform to root, or only to element, a top-level element.'''
+        timings = {} if self.profile is not None else None
+        if element is None:
+            transform(root, timings)
+        else:
+            transform_elements([element], timings)
+        if timings is not None:
+            self.profile.add_transform_timings(timings)
+
+    def fetch_images(self, elements, baseDir=None):
+        '''Replace the sources of the images in elements by their local
+        copies in the asset cache, if it is open.  The images are fetched
+        all at once; relative paths are taken from baseDir.'''
+        if self.asset_cache.directory is None:
+            return
+        references = []
+        for element in elements:
+            for node in element.iter('img', 'src'):
+                if node.tag == 'img':
+                    if node.get('src'):
+                        references.append((node, node.get('src')))
+                elif (node.getparent() is not None) and (node.getparent().tag == 'image') and node.text:
+                    references.append((node, node.text.strip()))
+        paths = self.asset_cache.resolve(set([source for node, source in references]), baseDir)
+        for node, source in references:
+            path = paths.get(source)
+            if path is None:
+                continue
+            if node.tag == 'img':
+                node.set('src', path)
+            else:
+                node.text = path
+
+    def convert_math(self, root):
+        '''Convert the MathML below root in one go, see convert_math_batch.'''
+        return convert_math_batch(root, self.xslt_cache, self.math_cache)
+
+    def fingerprint(self, element):
+        '''Return a key for the LaTeX of a top-level element (with its tail).'''
+        return hashlib.sha1(self.template_hash + etree.tostring(element)).hexdigest()
+
+    def convert_top_level(self, elements, write, math=None):
+        '''Convert the top-level elements of a document, passing their LaTeX
+        to write.
+
+        If the fragment cache is open, elements converted before are taken
+        from there.  Otherwise the LaTeX may be written in pieces, see
+        delegate_pieces.  math maps the MathML elements to their LaTeX; by
+        default the MathML of each element that is converted is done in one
+        batch.
+        '''
+        if self.fragment_cache.directory is None:
+            self.convert_new(elements, write, math, pieces=True)
+            return
+        fragments = []
+        missing = []
+        for element in elements:
+            key = self.fingerprint(element)
+            fragments.append(self.fragment_cache.get(key))
+            if fragments[-1] is None:
+                missing.append((len(fragments) - 1, key, element))
+        if len(missing) > 0:
+            converted = []
+            self.convert_new([element for index, key, element in missing], converted.append)
+            for (index, key, element), latex in zip(missing, converted):
+                fragments[index] = latex
+                self.fragment_cache.put(key, latex)
+        for latex in fragments:
+            write(latex)
+
+    def convert_new(self, elements, write, math=None, pieces=False):
+        '''Convert top-level elements that are not in the fragment cache, in
+        the section pool if there are enough of them.  Unless pieces is
+        true, the LaTeX of each element is passed to write in one piece.'''
+        if (self.section_jobs > 1) and (len(elements) > 1):
+            size = 0
+            for element in elements:
+                size += sum([1 for node in element.iter()])
+            if size >= self.section_threshold:
+                for latex in self.convert_parallel(elements):
+                    write(latex)
+                return
+        if math is None:
+            math = {}
+            for element in elements:
+                math.update(self.convert_math(element))
+        self.convert_elements(elements, write, math, pieces)
+
+    def convert_parallel(self, elements):
+        '''Convert top-level elements in the section pool and return their
+        LaTeX, in order.
+
+        Each element is sent to a worker serialized, with the tags of its
+        ancestors, which some handlers look at.  The few elements that do
+        not survive the trip as XML (e.g. HTML with undeclared namespace
+        prefixes) are converted here.
+        '''
+        with self.section_pool_lock:
+            if self.section_pool is None:
+                self.section_pool = multiprocessing.Pool(self.section_jobs, initializer=init_section_worker,
+                    initargs=(self.templateSet, self.template_dir, self.cache_dir, self.math_cache.path,
+                              self.profile is not None))
+        ancestors = [ancestor.tag for ancestor in elements[0].iterancestors()]
+        ancestors.reverse()
+        job = functools.partial(convert_section_job, ancestors)
+        # a tail would be lost at the end of a serialized document
+        results = self.section_pool.map(job, [(etree.tostring(element, with_tail=False), element.tail)
+                                              for element in elements])
+        fragments = []
+        for latex, profileData in results:
+            fragments.append(latex)
+            if profileData is not None:
+                self.profile.merge(profileData)
+        for index, element in enumerate(elements):
+            if fragments[index] is None:
+                converted = []
+                self.convert_elements([element], converted.append, self.convert_math(element))
+                fragments[index] = converted[0]
+        return fragments
+
+    def close(self):
+        '''Stop the section pool, if one was started.'''
+        with self.section_pool_lock:
+            if self.section_pool is not None:
+                self.section_pool.close()
+                self.section_pool.join()
+                self.section_pool = None
+
+    def convert_elements(self, elements, write, math, pieces=False):
+        '''Convert elements, passing the LaTeX of each one to write, in
+        pieces if pieces is true (see delegate_pieces).  math maps the
+        MathML elements among them to their LaTeX.'''
+        previous = getattr(conversion_state, 'converter', None), getattr(conversion_state, 'math', None)
+        conversion_state.converter = self
+        conversion_state.math = math
+        try:
+            for element in elements:
+                if pieces:
+                    delegate_pieces(element, write)
+                else:
+                    write(delegate(element))
+        finally:
+            conversion_state.converter, conversion_state.math = previous
+            # formulas converted one at a time (see math_to_latex) are
+            # committed too, so that other processes can use them
+            self.math_cache.flush()
+
+    def convert_body(self, body, write):
+        '''Convert the children of body, passing their LaTeX to write.'''
+        if (self.fragment_cache.directory is None) and (self.section_jobs == 1):
+            # all the MathML of the document in one batch
+            self.convert_top_level(body, write, self.convert_math(body))
+        else:
+            self.convert_top_level(list(body), write)
+
+    def convert_tree(self, root, out=None, baseDir=None):
+        '''Convert a parsed document, whose images are relative to baseDir.
+
+        The LaTeX is written to the file object out if one is given and
+        returned as a unicode string otherwise.
+        '''
+        body = self.body(root)
+        self.fetch_images([body], baseDir)
+        if out is not None:
+            writer = LatexWriter(out, self.get_template('doc.tex'))
+            self.convert_body(body, writer.write)
+            writer.close()
+            return None
+        fragments = []
+        self.convert_body(body, fragments.append)
+        return self.get_template('doc.tex').render(content=u''.join(fragments))
+
+    def convert_stream(self, source, write):
+        '''Convert a cnxmlplus document while it is parsed from source, a file
+        name or file object, passing the LaTeX of each child of <content> to
+        write.
+
+        A child is converted as soon as the next one starts (by then its
+        tail has been read too) and is then removed from the tree, so the
+        memory used is bounded by the largest child rather than the book.
+        '''
+        baseDir = os.path.dirname(os.path.abspath(source)) if isinstance(source, basestring) else None
+        content = None
+        for event, element in etree.iterparse(source, events=('start', 'end'), huge_tree=True):
+            if content is None:
+                if (event == 'start') and (element.tag == 'content'):
+                    content = element
+            elif (event == 'start') and (element.getparent() is content):
+                self.convert_streamed(content, element, write, baseDir)
+            elif (event == 'end') and (element is content):
+                self.convert_streamed(content, None, write, baseDir)
+                break
+
+    def convert_streamed(self, content, following, write, baseDir=None):
+        '''Convert and remove the children of content before following, which
+        is still being parsed (None at the end of content).'''
+        for element in list(content):
+            if element is following:
+                break
+            unescape_entities(element)
+            self.transform(content, element)
+        # the transform may have replaced elements
+        elements = []
+        for element in content:
+            if element is following:
+                break
+            elements.append(element)
+        self.fetch_images(elements, baseDir)
+        self.convert_top_level(elements, write)
+        for element in elements:
+            content.remove(element)
+
+    def convert_string(self, text):
+        '''Convert the text of a document and return the LaTeX.'''
+        return self.convert_tree(self.parse(text))
+
+    def convert_file(self, path, outputName=None, stream=False):
+        '''Convert a file, by default to a .tex file next to it, and return
+        the name of the output file.  cnxmlplus files are converted while
+        they are parsed if stream is set, see convert_stream.'''
+        name, extension = path.rpartition('.')[0::2]
+        if outputName is None:
+            outputName = name + '.tex'
+        if stream and (self.templateSet == 'cnxmlplus'):
+            information_message("Converting %s.%s" %(name, extension))
+            out = open(outputName, 'w')
+            try:
+                writer = LatexWriter(out, self.get_template('doc.tex'))
+                try:
+                    self.convert_stream(path, writer.write)
+                except etree.XMLSyntaxError:
+                    error_message(path + " not valid")
+                writer.close()
+            finally:
+                out.close()
+            information_message("Output written to %s.%s.tex"%(name, extension))
+            return outputName
+        text = open(path, 'r').read()
+        if (self.templateSet == 'html') and (text.decode('utf-8').strip() == ''):
+            fout = open(outputName, 'w')
             fout.write('''%empty input file''')
             fout.close()
-            sys.exit()
+            return outputName
         try:
-            root = etree.HTML(open(sys.argv[1], 'r').read())
-        except:
-            error_message(sys.argv[1] + " not valid")
-
-        loader = jinja2.FileSystemLoader(os.path.dirname(os.path.realpath(__file__)) + '/templates/html')
-        texenv = setup_texenv(loader)
-        body = root.find('.//body')
-    elif (extension == 'cnxmlplus') or (extension == 'cnxml'):
-        root = etree.XML(open(sys.argv[1], 'r').read())
-        transform(root) 
-        loader = jinja2.FileSystemLoader(os.path.dirname(os.path.realpath(__file__)) + '/templates/cnxmlplus')
-        texenv = setup_texenv(loader)
-        body = root.find('.//content')
-#       if Textbook:
-#           # remove the solution tags if its a textbook
-#           for e in body.findall('.//solution'):
-#               if type(e) is not NoneType:
-#                   e.getparent().remove(e)
-    else:
+            root = self.parse(text)
+        except etree.XMLSyntaxError:
+            error_message(path + " not valid")
+        information_message("Converting %s.%s" %(name, extension))
+        out = open(outputName, 'w')
+        try:
+            self.convert_tree(root, out, os.path.dirname(os.path.abspath(path)))
+        finally:
+            out.close()
+        information_message("Output written to %s.%s.tex"%(name, extension))
+        return outputName
+
+# The converter and MathML of the document each thread is converting
+conversion_state = threading.local()
+
+# Converters for each template set, created once per process
+converters = {}
+converters_lock = threading.Lock()
+
+# Keyword arguments for the shared converters, see set_converter_options
+converter_options = {}
+
+def get_converter(templateSet):
+    '''Return this process's shared converter for the 'html' or 'cnxmlplus' templates.'''
+    with converters_lock:
+        if templateSet not in converters:
+            converters[templateSet] = Converter(templateSet, **converter_options)
+        return converters[templateSet]
+
+def set_converter_options(**options):
+    '''Set the Converter arguments of the shared converters, which are
+    created again when next used.'''
+    close_converters()
+    with converters_lock:
+        converter_options.clear()
+        converter_options.update(options)
+
+def close_converters():
+    with converters_lock:
+        for converter in converters.values():
+            converter.close()
+        converters.clear()
+
+# The converter of a section pool worker
+section_converter = None
+
+def init_section_worker(templateSet, templateDir, cacheDir, mathCachePath, profiling=False):
+    global section_converter
+    profile = Profile() if profiling else None
+    section_converter = Converter(templateSet, templateDir, cacheDir=cacheDir, profile=profile)
+    xslt_cache.warm()
+    if mathCachePath is not None:
+        math_cache.open(mathCachePath)
+
+def convert_section_job(ancestors, job):
+    '''Convert a top-level element in a section pool worker.
+
+    job is the XML of the element, serialized without its tail, and the
+    tail.  The element is placed below empty copies of its ancestors.
+    Returns the LaTeX, None if the element cannot be parsed again, and the
+    profile of the conversion if the worker keeps one.
+    '''
+    try:
+        element = etree.fromstring(job[0], XML_PARSER)
+    except etree.XMLSyntaxError:
+        return None, None
+    element.tail = job[1]
+    parent = None
+    for tag in ancestors:
+        if parent is None:
+            parent = etree.Element(tag)
+        else:
+            parent = etree.SubElement(parent, tag)
+    if parent is not None:
+        parent.append(element)
+    fragments = []
+    section_converter.convert_elements([element], fragments.append, section_converter.convert_math(element))
+    if section_converter.profile is not None:
+        return fragments[0], section_converter.profile.take()
+    return fragments[0], None
+
+def active_converter():
+    '''Return the converter at work in this thread, or the html converter if
+    elements are converted on their own.'''
+    converter = getattr(conversion_state, 'converter', None)
+    if converter is None:
+        converter = get_converter('html')
+        conversion_state.math = {}
+    return converter
+
+TEMPLATE_SETS = {'html': 'html', 'cnxmlplus': 'cnxmlplus', 'cnxml': 'cnxmlplus'}
+
+def find_input_files(names):
+    '''Expand file names, directories and glob patterns into a list of input files.'''
+    paths = []
+    for name in names:
+        if os.path.isdir(name):
+            for directory, subdirectories, filenames in os.walk(name):
+                subdirectories.sort()
+                for filename in sorted(filenames):
+                    if filename.rpartition('.')[-1] in TEMPLATE_SETS:
+                        paths.append(os.path.join(directory, filename))
+        elif os.path.exists(name):
+            paths.append(name)
+        else:
+            matches = sorted(glob.glob(name))
+            if len(matches) == 0:
+                warning_message('No input files match ' + name)
+            paths.extend(matches)
+    return paths
+
+def convert_file(path, stream=False):
+    '''Convert an .html, .cnxmlplus or .cnxml file and return the name of the
+    .tex file written next to it.'''
+    extension = path.rpartition('.')[-1]
+    information_message(extension + ' ' + path.rpartition('.')[-3])
+    if extension not in TEMPLATE_SETS:
         error_message('Unknown extension on input file type!')
+    return get_converter(TEMPLATE_SETS[extension]).convert_file(path, stream=stream)
+
+def precompile_templates(cacheDir=TEMPLATE_CACHE_DIR):
+    '''Compile the html and cnxmlplus templates into cacheDir, from which
+    converters load them instead of compiling them again.'''
+    if not os.path.isdir(cacheDir):
+        os.makedirs(cacheDir)
+    for templateSet in ['html', 'cnxmlplus']:
+        converter = Converter(templateSet, cacheDir=cacheDir)
+        information_message('Compiled %i %s templates into %s'%(len(converter.templates), templateSet, cacheDir))
+
+def init_worker(mathCachePath=None, fragmentCacheDir=None, converterOptions=None, assetDir=None):
+    '''Set up a batch worker process: templates, stylesheets and caches.'''
+    if converterOptions is not None:
+        set_converter_options(**converterOptions)
+    for templateSet in ['html', 'cnxmlplus']:
+        get_converter(templateSet)
+    xslt_cache.warm()
+    if mathCachePath is not None:
+        math_cache.open(mathCachePath)
+    if fragmentCacheDir is not None:
+        fragment_cache.open(fragmentCacheDir)
+    if assetDir is not None:
+        asset_cache.open(assetDir)
+
+def cache_counters():
+    '''Return the counters of the MathML, fragment and image caches of this
+    process.'''
+    return (math_cache.hits, math_cache.misses, math_cache.bytes_saved,
+            fragment_cache.hits, fragment_cache.misses,
+            asset_cache.fetched, asset_cache.reused, asset_cache.failed)
+
+def convert_file_job(path, stream=False):
+    '''Convert one file of a batch.
+
+    Returns (path, output file, seconds, error message, cache counters,
+    profile); errors are caught, and left to report_batch to report, so
+    that one bad file does not stop the batch.
+    '''
+    start = time.time()
+    counters = cache_counters()
+    outputName = None
+    error = None
+    try:
+        outputName = convert_file(path, stream)
+    except Exception, e:
+        error = '%s: %s'%(e.__class__.__name__, e)
+    counters = tuple([after - before for before, after in zip(counters, cache_counters())])
+    profile = converter_options.get('profile')
+    if profile is not None:
+        profile = profile.take()
+    return path, outputName, time.time() - start, error, counters, profile
+
+def convert_files(paths, jobs=1, mathCachePath=None, stream=False, fragmentCacheDir=None,
+                  converterOptions=None, profile=None, assetDir=None):
+    '''Convert a list of files, in a pool of jobs worker processes if jobs > 1.
+    converterOptions are passed to the Converters, the conversions are
+    recorded in profile if one is given and the images are copied to
+    assetDir if one is given.
+
+    Returns the results of convert_file_job in the order of paths.
+    '''
+    converterOptions = dict(converterOptions or {})
+    if profile is not None:
+        converterOptions['profile'] = profile
+    if jobs == 1:
+        init_worker(mathCachePath, fragmentCacheDir, converterOptions or None, assetDir)
+        results = [convert_file_job(path, stream) for path in paths]
+        close_converters()
+    else:
+        # the workers record their own profiles, which are merged below
+        if profile is not None:
+            converterOptions['profile'] = Profile()
+        pool = multiprocessing.Pool(jobs, initializer=init_worker,
+                                    initargs=(mathCachePath, fragmentCacheDir, converterOptions, assetDir))
+        try:
+            results = pool.map(functools.partial(convert_file_job, stream=stream), paths, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    if profile is not None:
+        for result in results:
+            profile.merge(result[5])
+    if jobs == 1:
+        return results
+    # count the workers' cache use in this process, for the report
+    for result in results:
+        math_cache.hits += result[4][0]
+        math_cache.misses += result[4][1]
+        math_cache.bytes_saved += result[4][2]
+        fragment_cache.hits += result[4][3]
+        fragment_cache.misses += result[4][4]
+        asset_cache.fetched += result[4][5]
+        asset_cache.reused += result[4][6]
+        asset_cache.failed += result[4][7]
+    return results
+
+def report_batch(results, seconds):
+    '''Write the timings and failures of a batch to stderr; return the number of failures.'''
+    failures = [result for result in results if result[3] is not None]
+    if len(results) > 1:
+        for path, outputName, fileSeconds, error, counters, profile in results:
+            information_message('%8.2fs  %s'%(fileSeconds, path))
+        information_message('Converted %i of %i files in %.2fs'%(len(results) - len(failures), len(results), seconds))
+    for path, outputName, fileSeconds, error, counters, profile in failures:
+        error_message('%s: %s'%(path, error), terminate=False)
+    return len(failures)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Convert html or cnxmlplus to LaTeX.')
+    parser.add_argument('inputs', nargs='*', metavar='input',
+                        help='.html, .cnxmlplus or .cnxml file, directory or glob pattern to convert')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='number of worker processes for batches (default: one per CPU)')
+    parser.add_argument('--math-cache', metavar='PATH',
+                        help='sqlite database in which to keep MathML conversions between runs')
+    parser.add_argument('--fragment-cache', metavar='DIR',
+                        help='directory in which to keep the LaTeX of each section, so that only '
+                             'changed sections are converted again')
+    parser.add_argument('--images', metavar='DIR',
+                        help='copy the images of the documents to DIR, named by their content, '
+                             'and refer to the copies')
+    parser.add_argument('--section-jobs', type=int, default=1, metavar='N',
+                        help='convert the top-level sections of large documents in N processes; '
+                             'only used when files are converted one at a time (--jobs 1)')
+    parser.add_argument('--stream', action='store_true',
+                        help='convert cnxmlplus files while they are read, to save memory on large books')
+    parser.add_argument('--profile', action='store_true',
+                        help='report the time spent on each kind of element')
+    parser.add_argument('--profile-json', metavar='PATH',
+                        help='write the time spent on each kind of element to PATH as JSON')
+    parser.add_argument('--precompile', action='store_true',
+                        help='compile the templates into %s for faster start-up'%TEMPLATE_CACHE_DIR)
+    args = parser.parse_args(argv)
+
+    if args.precompile:
+        precompile_templates()
+        if len(args.inputs) == 0:
+            return 0
+    elif len(args.inputs) == 0:
+        parser.error('no input files given')
+
+    paths = find_input_files(args.inputs)
+    if len(paths) == 0:
+        error_message('No input files found', terminate=False)
+        return 1
+    jobs = args.jobs
+    if jobs is None:
+        jobs = multiprocessing.cpu_count()
+    jobs = max(1, min(jobs, len(paths)))
+
+    converterOptions = {}
+    if args.section_jobs > 1:
+        if jobs == 1:
+            converterOptions['sectionJobs'] = args.section_jobs
+        else:
+            warning_message('--section-jobs is only used with --jobs 1')
+    profile = None
+    if args.profile or (args.profile_json is not None):
+        profile = Profile()
+
+    start = time.time()
+    results = convert_files(paths, jobs, args.math_cache, args.stream, args.fragment_cache,
+                            converterOptions, profile, args.images)
+    math_cache.report()
+    fragment_cache.report()
+    asset_cache.report()
+    if args.profile:
+        profile.report()
+    if args.profile_json is not None:
+        open(args.profile_json, 'w').write(profile.json())
+    if report_batch(results, time.time() - start) > 0:
+        return 1
+    return 0
+
 
-    information_message("Converting %s.%s" %(filename, extension))
-    content = ''.join([delegate(element) for element in body])
-    main_template = texenv.get_template('doc.tex')
-    output = unicode(unescape(main_template.render(content=content))).encode('utf-8').replace(r'& \\ \hline', r'\\ \hline')
-    #output = clean(output)
-    open('%s.tex'%filename, 'w').write(output)
-    information_message("Output written to %s.%s.tex"%(filename, extension))
+if __name__ == "__main__":
+    sys.exit(main())
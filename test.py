@@ -18,3 +18,475 @@ def test():
 
     '''
     pass
+
+
+def test_xslt_cache():
+    r'''
+
+    >>> from html2latex import XSLTCache, xslt_cache
+    >>> cache = XSLTCache(xslt_cache.directory)
+    >>> cache.warm()
+    >>> cache.get('mmltex.xsl') is cache.get('mmltex.xsl')
+    True
+    >>> sorted(cache.stats().items())
+    [('compiled', 1), ('hits', 2), ('misses', 1)]
+
+    '''
+    pass
+
+
+def test_math_cache():
+    r'''
+
+    >>> from lxml import etree
+    >>> from html2latex import MathCache, LRUCache
+    >>> lru = LRUCache(2)
+    >>> lru.put('a', 1); lru.put('b', 2); lru.get('a'); lru.put('c', 3)
+    1
+    >>> lru.get('b') is None, len(lru)
+    (True, 2)
+    >>> lru.put('a', 4); lru.put('d', 5)
+    >>> lru.get('c') is None, lru.get('a')
+    (True, 4)
+
+    >>> cache = MathCache()
+    >>> root = etree.XML('<p><math xmlns="http://www.w3.org/1998/Math/MathML"><mi>x</mi></math></p>')
+    >>> key = cache.key(root[0])
+    >>> cache.get(key) is None
+    True
+    >>> cache.put(key, u'x')
+    >>> cache.get(key), cache.hits, cache.misses, cache.bytes_saved
+    (u'x', 1, 1, 1)
+
+    Conversions kept in a database are dropped when the stylesheets or the
+    code that cleans up their output change:
+
+    >>> import os, tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), 'math.sqlite')
+    >>> cache = MathCache(path=path)
+    >>> cache.put(key, u'x'); cache.flush()
+    >>> MathCache(path=path).get(key)
+    u'x'
+    >>> store = MathCache()
+    >>> store.open(path, version='older'); store.get(key) is None
+    True
+    >>> MathCache(path=path).get(key) is None
+    True
+    >>> import shutil; shutil.rmtree(os.path.dirname(path))
+
+    '''
+    pass
+
+
+SHARED_MATH = '<math xmlns="http://www.w3.org/1998/Math/MathML"><mi>y</mi></math>'
+
+def share_math_cache(path, converted, done):
+    '''Convert a formula on its own with the MathCache at path, then wait
+    until done is set.'''
+    from html2latex import Converter, MathCache
+    converter = Converter('cnxmlplus', mathCache=MathCache(path=path))
+    root = converter.parse('<document><content><para>%s</para></content></document>' % SHARED_MATH)
+    converter.convert_elements(converter.body(root), lambda latex: None, {})
+    converted.set()
+    done.wait()
+
+def test_shared_math_cache():
+    import multiprocessing, os, shutil, tempfile
+    from lxml import etree
+    from html2latex import MathCache
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'math.sqlite')
+        converted, done = multiprocessing.Event(), multiprocessing.Event()
+        process = multiprocessing.Process(target=share_math_cache, args=(path, converted, done))
+        process.start()
+        try:
+            assert converted.wait(60)
+            # the other process is still running, but its formula is there
+            cache = MathCache(path=path)
+            assert cache.get(cache.key(etree.XML(SHARED_MATH))) == 'y'
+        finally:
+            done.set()
+            process.join()
+    finally:
+        shutil.rmtree(directory)
+
+
+# The string by string implementations that the single pass translators in
+# html2latex replaced, to check that they give the same results.
+
+def reference_escape_latex(text):
+    text = text.replace(r'&', r'\&')
+    text = text.replace(r'#', r'\#')
+    text = text.replace(r'_', r'\_')
+    text = text.replace(r'%', r'\%')
+    text = text.replace(r'\\%', r'\%')
+    text = text.replace(r'\\%', r'\%')
+    text = text.replace(r'\rm', r'\mathrm')
+    return text
+
+def reference_unescape_latex(text):
+    text = text.replace(r'\%', r'%')
+    text = text.replace(r'\_', r'_')
+    text = text.replace(r'\#', r'#')
+    text = text.replace(r'\&', r'&')
+    return text
+
+def reference_escape_tex(value):
+    import re
+    for pattern, replacement in [
+            (r'\\', r'\\textbackslash'),
+            (r'([{}_#%&$])', r'\\\1'),
+            (r'~', r'\~{}'),
+            (r'\^', r'\^{}'),
+            (r'"', r"''"),
+            (r'\.\.\.+', r'\\ldots')]:
+        value = re.sub(pattern, replacement, value)
+    return value
+
+def reference_clean(text):
+    text = text.replace(u'\u00c2', ' ')
+    text = text.replace(u'\u00e2\u0080\u009c', '')
+    text = text.replace(u'\u00e2\u0080\u009d', '')
+    text = text.replace(u'\u00e2\u0080\u0099', '\'')
+    text = text.replace(u'\u00e2\u0080\u0093', '')
+    text = text.replace(u'\u00a0', ' ')
+    return text
+
+def escaping_corpus():
+    import glob
+    import os
+    from lxml import etree
+    texts = [u'', u'50%', u'\\%', u'\\\\%', u'\\\\\\%', u'a & b # c_d', u'\\rm x', u'\\\\rm',
+             u'{x} ~ ^ "q" ... .... \\', u'\u00e2\u0080\u009cquoted\u00e2\u0080\u009d',
+             u'it\u00e2\u0080\u0099s \u00c2\u00a0here \u00e2\u0080\u0093', u'\\&\\_\\#\\%',
+             u'x\u00e2\u0080\u00e2\u0080\u009c\u0099y']
+    for path in glob.glob(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'tests', '*.html')):
+        for element in etree.HTML(open(path).read()).iter():
+            texts.extend([t for t in [element.text, element.tail] if t is not None])
+    return texts
+
+def test_escaping_equivalence():
+    import html2latex
+    for text in escaping_corpus():
+        assert html2latex.escape_latex(text) == reference_escape_latex(text), repr(text)
+        assert html2latex.unescape_latex(text) == reference_unescape_latex(text), repr(text)
+        assert html2latex.escape_tex(text) == reference_escape_tex(text), repr(text)
+        assert html2latex.clean(text) == reference_clean(text), repr(text)
+        escaped = reference_escape_latex(text)
+        assert html2latex.unescape_latex(escaped) == reference_unescape_latex(escaped), repr(text)
+
+
+def test_unescape_entities():
+    r'''
+
+    >>> from lxml import etree
+    >>> from html2latex import unescape_entities
+    >>> root = etree.XML('<p>a&amp;nbsp;b <b>&amp;#215;</b> &amp;unknown; &amp;amp;</p>')
+    >>> unescape_entities(root)
+    >>> root.text, root[0].text, root[0].tail
+    (u'a\xa0b ', u'\xd7', ' &unknown; &')
+
+    '''
+    pass
+
+
+def test_format_numbers():
+    r'''
+
+    >>> import html2latex
+    >>> html2latex.format_numbers(['12', '-1234567', '3.14159'])
+    ['12', '&#8722;1\\ 234\\ 567', '3,141\\ 59']
+    >>> html2latex.format_number('12345.5', '.', ',')
+    '12,345.5'
+    >>> for i in range(html2latex.NUMBER_CACHE_SIZE + 1):
+    ...     _ = html2latex.format_number(str(i))
+    >>> len(html2latex.number_cache) <= html2latex.NUMBER_CACHE_SIZE
+    True
+
+    '''
+    pass
+
+
+def test_find_input_files():
+    import os, tempfile, shutil
+    from html2latex import find_input_files
+    directory = tempfile.mkdtemp()
+    try:
+        for name in ['a.html', 'b.cnxmlplus', 'notes.txt', 'sub/c.cnxml']:
+            path = os.path.join(directory, name)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            open(path, 'w').close()
+        found = find_input_files([directory])
+        assert [os.path.relpath(p, directory) for p in found] == ['a.html', 'b.cnxmlplus', 'sub/c.cnxml'], found
+        found = find_input_files([os.path.join(directory, '*.html'), os.path.join(directory, 'notes.txt')])
+        assert [os.path.basename(p) for p in found] == ['a.html', 'notes.txt'], found
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_converter_threads():
+    from multiprocessing.pool import ThreadPool
+    from html2latex import Converter
+    html = Converter('html')
+    cnxmlplus = Converter('cnxmlplus')
+    jobs = [(html, '<p>Text %i &amp; <b>bold</b></p><h1>Title %i</h1>'%(i, i)) for i in range(20)]
+    jobs += [(cnxmlplus, '<document><content><para>Para %i <emphasis>x</emphasis></para></content></document>'%i) for i in range(20)]
+    expected = [converter.convert_string(text) for converter, text in jobs]
+    pool = ThreadPool(8)
+    try:
+        results = pool.map(lambda job: job[0].convert_string(job[1]), jobs * 5)
+    finally:
+        pool.close()
+    assert results == expected * 5
+
+
+def test_template_resolution():
+    from html2latex import Converter
+    converter = Converter('cnxmlplus')
+    assert converter.tag_template('para') is converter.get_template('para.tex')
+    assert converter.tag_template('no-such-tag') is converter.get_template('not_implemented.tex')
+    assert converter.tag_template('{http://www.w3.org/1998/Math/MathML}math') is converter.not_implemented
+
+
+def test_precompiled_templates():
+    import os, tempfile, shutil
+    from html2latex import Converter, precompile_templates
+    cacheDir = os.path.join(tempfile.mkdtemp(), 'cache')
+    try:
+        precompile_templates(cacheDir)
+        cached = Converter('html', cacheDir=cacheDir)
+        assert len(os.listdir(cacheDir)) >= len(cached.templates)
+        text = '<h1>Title</h1><p>Some <b>bold</b> text &amp; more</p>'
+        assert cached.convert_string(text) == Converter('html', cacheDir=None).convert_string(text)
+    finally:
+        shutil.rmtree(os.path.dirname(cacheDir))
+
+
+def test_streaming_conversion():
+    from StringIO import StringIO
+    from html2latex import Converter
+    document = '''<document><title>Book</title><content>
+<section><title>One</title><para>A <number>12345.6</number> &amp;amp; <currency><number>5</number></currency></para></section>
+<!-- comment -->
+<section><title>Two</title><section><title>Deep</title><para>Text</para></section></section>
+<para>Tail <percentage>50</percentage></para>
+</content></document>'''
+    converter = Converter('cnxmlplus')
+    fragments = []
+    converter.convert_stream(StringIO(document), fragments.append)
+    assert converter.get_template('doc.tex').render(content=u''.join(fragments)) == converter.convert_string(document)
+
+
+def test_fragment_cache():
+    import os, tempfile, shutil
+    from html2latex import Converter, FragmentCache, XSLTCache, xslt_cache
+    directory = tempfile.mkdtemp()
+    try:
+        fragmentCache = FragmentCache(directory)
+        converter = Converter('html', fragmentCache=fragmentCache)
+        document = '<h1>Title</h1><p>First</p><p>Second</p>'
+        expected = Converter('html', fragmentCache=FragmentCache()).convert_string(document)
+        assert converter.convert_string(document) == expected
+        assert (fragmentCache.hits, fragmentCache.misses) == (0, 3)
+        assert converter.convert_string(document) == expected
+        assert (fragmentCache.hits, fragmentCache.misses) == (3, 3)
+        edited = document.replace('Second', 'Changed')
+        assert converter.convert_string(edited) == expected.replace('Second', 'Changed')
+        assert (fragmentCache.hits, fragmentCache.misses) == (5, 4)
+        # fragments are not reused after the MathML stylesheets change
+        stylesheets = os.path.join(directory, 'xslt')
+        shutil.copytree(xslt_cache.directory, stylesheets)
+        open(os.path.join(stylesheets, 'mmltex.xsl'), 'ab').write('\n')
+        edited = Converter('html', fragmentCache=fragmentCache, xsltCache=XSLTCache(stylesheets))
+        assert edited.template_hash != converter.template_hash
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_parallel_sections():
+    from html2latex import Converter
+    document = '''<html><body><h1>Title</h1>
+<p>Text &amp; <b>bold</b></p>
+<div class="note"><p>Note</p></div> tail text
+<table><tr><td>1</td><td>2</td></tr></table></body></html>'''
+    parallel = Converter('html', sectionJobs=2, sectionThreshold=0)
+    try:
+        assert parallel.convert_string(document) == Converter('html').convert_string(document)
+    finally:
+        parallel.close()
+
+
+def test_profile():
+    import json
+    from html2latex import Converter, Profile
+    document = '<html><body><p>Text <b>bold</b> <b>more</b></p></body></html>'
+    profile = Profile()
+    assert Converter('html', profile=profile).convert_string(document) == Converter('html').convert_string(document)
+    data = profile.take()
+    counts = dict([((row[0], row[1]), row[2]) for row in data['elements']])
+    assert counts[('b', '')] == 2 and counts[('p', '')] == 1, counts
+    for row in data['elements']:
+        assert row[3] >= row[4] >= 0 # inclusive and exclusive time
+    # the figures of other processes are added up
+    profile.merge(data)
+    profile.merge(data)
+    rows = json.loads(profile.json())['elements']
+    assert [row['count'] for row in rows if row['tag'] == 'b'] == [4]
+    # an element that cannot be converted does not stay on the stack
+    converter = Converter('cnxmlplus', profile=profile)
+    try:
+        converter.convert_string('<document><content><section><title>T</title><para>'
+                                 '<latex display="bogus">x</latex></para></section></content></document>')
+    except ValueError:
+        pass
+    else:
+        assert False, 'the latex element was converted'
+    assert profile.depth() == 0
+
+
+def test_element_context():
+    from lxml import etree
+    from html2latex import element_context
+    root = etree.XML('<content><section><table><latex display="block">x</latex></table>'
+                     '<section><exercise><figure/></exercise></section></section></content>')
+    figure = root.find('.//figure')
+    context = element_context(figure)
+    assert (context.inside_table, context.inside_float, context.section_depth) == (False, True, 2)
+    context = element_context(root.find('.//latex'))
+    assert (context.inside_table, context.inside_latex, context.section_depth) == (True, True, 1)
+
+
+def test_table_model():
+    from lxml import etree
+    from html2latex import TableModel, Converter
+    table = etree.HTML('<table><tr><th>a</th><th>b</th><th>c</th></tr>'
+                       '<tr><td rowspan="2">d</td><td colspan="2">e</td></tr>'
+                       '<tr><td>f</td><td>g</td></tr></table>').find('.//table')
+    model = TableModel(table)
+    assert model.ncols == 3 and model.html and (model.rows == 3)
+    assert [(kind, element.tag) for kind, element in model.items] == [('row', 'tr')]*3
+    model = TableModel(etree.XML('<table><title>t</title><tgroup cols="1"><tbody><row><entry>a</entry></row>'
+                                 '</tbody></tgroup></table>'))
+    assert [(kind, element.tag) for kind, element in model.items] == \
+        [('other', 'title'), ('start', 'tgroup'), ('start', 'tbody'), ('row', 'row'),
+         ('end', 'tbody'), ('end', 'tgroup')]
+    assert (model.ncols == 1) and model.tgroup and not model.html
+    # images are fit to the columns
+    latex = Converter('cnxmlplus').convert_string(
+        '<document><content><table><tgroup cols="2"><tbody><row><entry><image><src>a.png</src></image></entry>'
+        '<entry><para>x</para></entry></row></tbody></tgroup></table></content></document>')
+    assert r'\includegraphics[width=0.375\textwidth]{a.png}' in latex, latex
+    assert 'center' not in latex
+    # children that are not rows go before them
+    latex = Converter('html').convert_string(
+        '<html><body><table><caption>c</caption><tr><td>a</td></tr></table></body></html>')
+    assert latex.index('caption') < latex.index(r'a \\ \hline'), latex
+
+
+def test_table_pieces():
+    from lxml import etree
+    from html2latex import Converter, Profile, start_handler
+    converter = Converter('cnxmlplus')
+    rows = ''.join(['<row><entry>%i</entry><entry><para>x</para></entry></row>' % i for i in range(50)])
+    document = '<document><content><section><title>T</title><para>p</para>' \
+               '<table><tgroup cols="2"><tbody>%s</tbody></tgroup></table></section></content></document>' % rows
+    whole = []
+    body = converter.body(converter.parse(document))
+    converter.convert_elements(body, whole.append, {})
+    pieces = []
+    body = converter.body(converter.parse(document))
+    converter.convert_elements(body, pieces.append, {}, pieces=True)
+    assert len(whole) == 1 and len(pieces) > 50
+    assert ''.join(pieces) == whole[0]
+    # the time spent rendering the pieces is profiled
+    profile = Profile()
+    converter = Converter('cnxmlplus', profile=profile)
+    converter.convert_elements(converter.body(converter.parse(document)), pieces.append, {}, pieces=True)
+    # the cells, converted as the table renders, are not counted as rendering
+    assert [0 < row[5] <= row[4] for row in profile.take()['elements'] if row[0] == 'table'] == [True]
+    # a section whose template edits its text is not written in pieces
+    document = '<document><content><section type="note"><title>N</title><para>p</para> \n' \
+               '</section></content></document>'
+    whole = []
+    converter.convert_elements(converter.body(converter.parse(document)), whole.append, {})
+    pieces = []
+    converter.convert_elements(converter.body(converter.parse(document)), pieces.append, {}, pieces=True)
+    assert ''.join(pieces) == ''.join(whole)
+    # the rows are converted once
+    handler = start_handler(etree.HTML('<table><tr><td>a</td></tr></table>').find('.//table'))
+    handler.finish()
+    assert list(handler.content['lines']) == [r'a \\ \hline', '']
+    try:
+        list(handler.content['lines'])
+    except RuntimeError:
+        pass
+    else:
+        assert False, 'the rows were converted twice'
+
+
+def test_fetch_images():
+    import os
+    import shutil
+    import tempfile
+    from html2latex import Converter, AssetCache
+    directory = tempfile.mkdtemp()
+    try:
+        open(os.path.join(directory, 'a.dat'), 'wb').write('\x89PNG\r\n\x1a\ndata')
+        open(os.path.join(directory, 'b.png'), 'wb').write('\x89PNG\r\n\x1a\ndata')
+        cache = AssetCache(os.path.join(directory, 'cache'))
+        converter = Converter('html', assetCache=cache)
+        root = converter.parse('<html><body><img src="a.dat"/><img src="file://%s/b.png"/>'
+                               '<img src="missing.png"/></body></html>' % directory)
+        latex = converter.convert_tree(root, baseDir=directory)
+        # one copy of the two files with the same content, named as a PNG
+        copies = [name for name in os.listdir(os.path.join(directory, 'cache')) if len(name) == 2]
+        assert len(copies) == 1
+        name = os.listdir(os.path.join(directory, 'cache', copies[0]))[0]
+        assert name.endswith('.png')
+        assert latex.count(name) == 2 and '{missing.png}' in latex, latex
+        assert (cache.fetched, cache.reused, cache.failed) == (1, 1, 1)
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_deep_nesting():
+    import sys
+    from lxml import etree
+    from html2latex import delegate
+    depth = 2 * sys.getrecursionlimit()
+    root = etree.HTML('<div>' * depth + 'text' + '</div>' * depth, etree.HTMLParser(huge_tree=True))
+    assert delegate(root.find('.//body')[0]).strip() == 'text'
+
+
+def test_deep_documents():
+    import sys
+    from html2latex import Converter
+    depth = 3 * sys.getrecursionlimit()
+    latex = Converter('html').convert_string(
+        '<html><body><p>' + '<span>' * depth + 'deep text' + '</span>' * depth + '</p></body></html>')
+    assert 'deep text' in latex, latex
+    latex = Converter('cnxmlplus').convert_string(
+        '<document><content><para>' + '<emphasis>' * depth + 'deep <unit_number><unit>m</unit>'
+        '<number>12</number></unit_number>' + '</emphasis>' * depth + '</para></content></document>')
+    assert 'deep 12' in latex, latex
+
+
+def test_element_content():
+    r'''
+
+    >>> from lxml import etree
+    >>> from html2latex import html_element
+    >>> element = etree.XML('<my_tag type="a_b" text="replaced">text</my_tag>')
+    >>> content = html_element(element).content
+    >>> content['type'], content['tag'], content['class'], content['text']
+    ('a_b', 'my\\_tag', '', 'replaced')
+    >>> content['missing']
+    Traceback (most recent call last):
+    KeyError: 'missing'
+    >>> hasattr(html_element(element), '__dict__')
+    False
+
+    '''
+    pass